@@ -1,36 +1,23 @@
 #!/usr/bin/env python3
 
-import plac, os, imageio, sys, numpy, functools
+import plac, os, imageio, imageio_ffmpeg, sys, numpy, multiprocessing, dask
 from matplotlib import pyplot
-from matplotlib.tri import Triangulation
 from cartopy import crs
 from cartopy.util import add_cyclic_point
-from xarray import open_mfdataset
+from stream_index import open_stream
 from time import perf_counter
-from scipy.interpolate import griddata
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from e3smplot.e3sm_utils import get_data
-from plot_map import plot_map
+from plot_map import plot_map, fix_longitudes as wrap_longitudes
+from grid_cache import get_triangulation, get_regrid_index
+from raster_map import get_raster_index, get_raster_shape, rasterize
+from prefetch import Prefetcher
+from stream_stats import get_stats
 
 
 def open_files(*inputfiles):
     print('Found %i files'%len(inputfiles))
-    return open_mfdataset(inputfiles, data_vars='minimal', coords='minimal', compat='override')
-
-
-def memoize(func):
-    cache = dict()    
-    @functools.wraps(func)
-    def memoized_func(*args, **kwargs):
-        key = str(args) + str(kwargs)
-        if key not in cache:
-            cache[key] = func(*args, **kwargs)
-        return cache[key]
-    return memoized_func
-
-
-@memoize
-def get_triangulation(lon, lat):
-    return Triangulation(lon, lat)
+    return open_stream(*inputfiles)
 
 
 def fix_longitudes(lon):
@@ -39,11 +26,11 @@ def fix_longitudes(lon):
 
 
 def plot_frame(dataset, variable_name, frame_name,
-               projection=crs.PlateCarree(),
+               projection=crs.PlateCarree(), data=None,
                **kwargs):
 
-    # Select data
-    data = get_data(dataset, variable_name).squeeze()
+    # Select data (unless already loaded)
+    if data is None: data = get_data(dataset, variable_name).squeeze()
     lon = get_data(dataset, 'lon').squeeze()
     lat = get_data(dataset, 'lat').squeeze()
 
@@ -56,16 +43,107 @@ def plot_frame(dataset, variable_name, frame_name,
     # Plot
     figure, axes = pyplot.subplots(1, 1, subplot_kw=dict(projection=projection), figsize=(10, 8))
     pl, cb = plot_map(lon, lat, data, **kwargs)
-    axes.set_title('time = %04i-%02i-%02i %02i:%02i:%02i'%(
-        data['time.year'], data['time.month'], data['time.day'],
-        data['time.hour'], data['time.minute'], data['time.second']
-    ))
+    axes.set_title(get_time_title(data))
 
     # Save figure
     figure.savefig(frame_name, dpi=100)
     pyplot.close()
 
 
+def get_time_title(data):
+    return 'time = %04i-%02i-%02i %02i:%02i:%02i'%(
+        data['time.year'], data['time.month'], data['time.day'],
+        data['time.hour'], data['time.minute'], data['time.second']
+    )
+
+
+def get_updater(pl, lon, lat, axes, plot_method='triangulation', nlon=360, nlat=180, cache=True):
+    '''
+    Return a function that swaps new column values into an artist created by
+    plot_map, so the figure, axes, coastlines and colorbar are only built once
+    '''
+    lon = wrap_longitudes(lon).values
+    lat = numpy.asarray(lat)
+    if plot_method == 'triangulation':
+        # tripcolor colors each triangle by the mean of its vertex values
+        triangles = get_triangulation(lon, lat).triangles
+        return lambda values: pl.set_array(values[triangles].mean(axis=1))
+    elif plot_method == 'regrid':
+        index = get_regrid_index(lon, lat, nlon, nlat)
+        return lambda values: pl.set_array(numpy.take(values, index))
+    elif plot_method == 'raster':
+        shape = get_raster_shape(axes)
+        pixel, fill = get_raster_index(lon, lat, axes.projection, axes.get_extent(), shape, cache=cache)
+        return lambda values: pl.set_data(rasterize(values, pixel, fill, shape))
+    else:
+        raise ValueError('method %s not known'%plot_method)
+
+
+def read_slices(dataset, variable_name, indices, prefetch=2):
+    '''
+    Iterate over (index, data) for the given time indices, loading the next
+    prefetch time slices in a background thread while the current frame is
+    drawn. The returned Prefetcher keeps timing counters (see summary()).
+    '''
+    def _load(i):
+        return get_data(dataset.isel(time=i), variable_name).squeeze().load()
+    return Prefetcher(_load, indices, depth=int(prefetch))
+
+
+def iter_frames(dataset, variable_name, slices, rotate=False, samples_per_day=48, **kwargs):
+    '''
+    Draw (index, data) time slices (see read_slices) in turn on a single
+    figure, yielding (index, figure) once each frame is ready. With a fixed projection only
+    the plotted values change between frames; when the projection changes
+    (rotating globe) the map axes are rebuilt in place but the figure and
+    colorbar are kept. Frames look the same as those from plot_frame, but are
+    not guaranteed to match them pixel for pixel.
+    '''
+    lon = get_data(dataset, 'lon').squeeze()
+    lat = get_data(dataset, 'lat').squeeze()
+    method_kw = {k: kwargs[k] for k in ('plot_method', 'nlon', 'nlat', 'cache') if k in kwargs}
+    figure = None
+    try:
+        for i, data in slices:
+            if 'lev' in data.dims: raise RuntimeError('Weird dimensions')
+            projection = get_projection(i, rotate, samples_per_day)
+            if figure is None:
+                figure, axes = pyplot.subplots(1, 1, subplot_kw=dict(projection=projection), figsize=(10, 8))
+                pl, cb = plot_map(lon, lat, data, axes=axes, **kwargs)
+                update = get_updater(pl, lon, lat, axes, **method_kw) if len(data.shape) == 1 and rotate != "True" else None
+            elif update is None:
+                # Replace the map axes with one in the same subplot slot, so it
+                # is plotted at the same size as a fresh figure would be, and
+                # then shrunk to make room for the colorbar by the same locator
+                locator = axes.get_axes_locator()
+                subplotspec = axes.get_subplotspec()
+                axes.remove()
+                axes = figure.add_subplot(subplotspec, projection=projection)
+                pl, __ = plot_map(lon, lat, data, axes=axes, draw_colorbar=False, **kwargs)
+                axes.set_axes_locator(locator)
+            else:
+                # Keep the data type, as plot_map does, so colours are
+                # normalized with the same precision
+                update(data.values)
+            axes.set_title(get_time_title(data))
+            yield i, figure
+    finally:
+        if figure is not None: pyplot.close(figure)
+
+
+def plot_frames_fast(dataset, variable_name, frames, rotate=False, samples_per_day=48, prefetch=2, progress=True, **kwargs):
+    '''
+    Plot (index, frame_name) pairs reusing a single figure (see iter_frames)
+    '''
+    reader = read_slices(dataset, variable_name, [i for i, frame_name in frames], prefetch)
+    drawn = iter_frames(dataset, variable_name, reader, rotate=rotate, samples_per_day=samples_per_day, **kwargs)
+    for n, ((i, frame_name), (__, figure)) in enumerate(zip(frames, drawn)):
+        figure.savefig(frame_name, dpi=100)
+        if progress: update_progress(n+1, len(frames))
+    drawn.close()
+    if progress: print(reader.summary()); sys.stdout.flush()
+
+
 # Get a time-varying longitude to be used to rotate map center to mimic earth
 # rotation in animations
 def rotate_longitude(itime, samples_per_day, start_lon=360):
@@ -74,50 +152,178 @@ def rotate_longitude(itime, samples_per_day, start_lon=360):
     return central_longitude
    
 
+# Projection for each frame; rotating globe or fixed lat/lon map
+def get_projection(itime, rotate=False, samples_per_day=48):
+    if rotate == "True":
+        central_longitude = rotate_longitude(itime, samples_per_day)
+        return crs.Orthographic(central_longitude=central_longitude, central_latitude=20)
+    else:
+        return crs.PlateCarree(central_longitude=180)
+
+
+def render_frames(dataset, variable_name, frames, rotate=False, samples_per_day=48, fast=False, prefetch=2, progress=True, **kwargs):
+    if fast in (True, "True"):
+        plot_frames_fast(dataset, variable_name, frames, rotate=rotate, samples_per_day=samples_per_day, prefetch=prefetch, progress=progress, **kwargs)
+        return
+    reader = read_slices(dataset, variable_name, [i for i, frame_name in frames], prefetch)
+    for n, ((i, frame_name), (__, data)) in enumerate(zip(frames, reader)):
+        plot_frame(
+            dataset.isel(time=i), variable_name, frame_name, 
+            projection=get_projection(i, rotate, samples_per_day),
+            data=data, **kwargs
+        )
+        if progress: update_progress(n+1, len(frames))
+    if progress: print(reader.summary()); sys.stdout.flush()
+
+
+# Dataset opened once by each frame rendering worker process
+_frame_state = {}
+
+
+def _init_frame_worker(inputfiles):
+    # Open files in the worker rather than sharing file handles across fork;
+    # grid caches (triangulation, raster lookup) then live for the life of
+    # the worker. The parent's dask thread pool does not survive the fork, and
+    # each worker only needs one thread anyway.
+    dask.config.set(scheduler='synchronous')
+    if inputfiles is not None:
+        _frame_state['dataset'] = open_files(*inputfiles)
+
+
+def _render_frame_block(variable_name, frames, kwargs):
+    render_frames(_frame_state['dataset'], variable_name, frames, progress=False, **kwargs)
+    return len(frames)
+
+
+def get_plot_kwargs(dataset, variable_name, rotate=False, **kwargs):
+
+    # Get data range so that all frames will be consistent; min and max come
+    # from a single sweep over the data
+    if 'vmin' not in kwargs.keys() or 'vmax' not in kwargs.keys():
+        stats, = get_stats(get_data(dataset, variable_name))
+        if 'vmin' not in kwargs.keys(): kwargs['vmin'] = stats.min
+        if 'vmax' not in kwargs.keys(): kwargs['vmax'] = stats.max
+
+    # Raster lookups for a rotating globe differ every frame; don't cache them
+    if rotate == "True" and kwargs.get('plot_method') == 'raster': kwargs['cache'] = False
+    return kwargs
+
+
 def plot_frames(
         dataset, variable_name, 
-        rotate=False, samples_per_day=48, 
+        rotate=False, samples_per_day=48, fast=False,
+        workers=1, inputfiles=None,
         **kwargs):
 
-    # Get data range so that all frames will be consistent
-    if 'vmin' not in kwargs.keys(): kwargs['vmin'] = get_data(dataset, variable_name).min().values
-    if 'vmax' not in kwargs.keys(): kwargs['vmax'] = get_data(dataset, variable_name).max().values
+    kwargs = get_plot_kwargs(dataset, variable_name, rotate=rotate, **kwargs)
 
-    # Loop over time series and make a plot for each
-    frames = []
+    # List frames in time order, skipping those that already exist
     print('Looping over %i time indices'%len(dataset.time)); sys.stdout.flush()
-    for i in range(len(dataset.time)):
-        frame_name = 'tmp_frames/%s.%i.png'%(variable_name, i)
-        os.makedirs(os.path.dirname(frame_name), exist_ok=True)
-        if os.path.exists(frame_name): 
-            frames.append(frame_name)
-            update_progress(i+1, len(dataset.time))
-            continue
-        if rotate == "True":
-            central_longitude = rotate_longitude(i, samples_per_day)
-            plot_frame(
-                dataset.isel(time=i), variable_name, frame_name, 
-                projection=crs.Orthographic(central_longitude=central_longitude, central_latitude=20),
-                **kwargs
-            )
-        else:
-            plot_frame(
-                dataset.isel(time=i), variable_name, frame_name, 
-                projection=crs.PlateCarree(central_longitude=180),
-                **kwargs
-            )
-        frames.append(frame_name)
-        update_progress(i+1, len(dataset.time))
+    frames = ['tmp_frames/%s.%i.png'%(variable_name, i) for i in range(len(dataset.time))]
+    for frame_name in frames: os.makedirs(os.path.dirname(frame_name), exist_ok=True)
+    todo = [(i, f) for i, f in enumerate(frames) if not os.path.exists(f)]
+    if len(todo) == 0: return frames
+
+    # Make a plot for each missing frame, either here or by handing out
+    # contiguous blocks of frames to a pool of worker processes
+    render_kw = dict(rotate=rotate, samples_per_day=samples_per_day, fast=fast, **kwargs)
+    workers = int(workers)
+    if workers <= 1:
+        render_frames(dataset, variable_name, todo, **render_kw)
+    else:
+        blocks = [b for b in numpy.array_split(numpy.arange(len(todo)), 4 * workers) if len(b)]
+        if inputfiles is None: _frame_state['dataset'] = dataset
+        try:
+            with ProcessPoolExecutor(
+                    workers, mp_context=multiprocessing.get_context('fork'),
+                    initializer=_init_frame_worker, initargs=(inputfiles,)) as executor:
+                futures = [executor.submit(_render_frame_block, variable_name, [todo[j] for j in b], render_kw) for b in blocks]
+                ndone = 0
+                for future in as_completed(futures):
+                    ndone += future.result()
+                    update_progress(ndone, len(todo))
+        finally:
+            _frame_state.clear()
 
     # Return list of frames
     return frames
 
 
-def animate_frames(outputfile, frames, **kwargs):
+class AnimationWriter(object):
+    '''
+    Incremental GIF, MP4 or WebP writer that pipes RGB frames to ffmpeg as
+    they are produced, so memory use does not grow with the number of frames.
+    GIF frames each get their own palette so ffmpeg never has to buffer the
+    whole animation.
+    '''
+    formats = {
+        '.gif': dict(
+            codec='gif', pix_fmt_out='pal8', macro_block_size=1,
+            output_params=['-filter_complex', 'split[a][b];[a]palettegen=stats_mode=single[p];[b][p]paletteuse=new=1', '-loop', '0'],
+        ),
+        '.webp': dict(codec='libwebp_anim', pix_fmt_out='yuv420p', macro_block_size=1, output_params=['-loop', '0', '-quality', '90']),
+        '.mp4': dict(codec='libx264', pix_fmt_out='yuv420p', macro_block_size=2, quality=8),
+    }
+
+    def __init__(self, outputfile, time_per_frame=0.1):
+        ext = os.path.splitext(outputfile)[1].lower()
+        if ext not in self.formats:
+            raise ValueError(f'Animation format {ext} not supported; use one of {", ".join(self.formats)}')
+        self.outputfile = outputfile
+        self.fps = 1.0 / float(time_per_frame)
+        self.options = self.formats[ext]
+        self.writer = None
+
+    def append_data(self, image):
+        image = numpy.ascontiguousarray(image[..., :3], dtype=numpy.uint8)
+        if self.writer is None:
+            # Frame size is only known once the first frame arrives
+            self.writer = imageio_ffmpeg.write_frames(
+                self.outputfile, (image.shape[1], image.shape[0]), fps=self.fps,
+                ffmpeg_log_level='error', **self.options
+            )
+            self.writer.send(None)
+        self.writer.send(image)
+
+    def close(self):
+        if self.writer is not None: self.writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def get_image(figure):
+    # Render a figure to an RGB(A) array in memory
+    figure.canvas.draw()
+    return numpy.asarray(figure.canvas.buffer_rgba())
+
+
+def write_animation(dataset, variable_name, outputfile, rotate=False, samples_per_day=48, time_per_frame=0.1, prefetch=2, **kwargs):
+    '''
+    Render every time index in order and stream each frame straight from the
+    figure's pixel buffer into the animation, with no intermediate files
+    '''
+    kwargs = get_plot_kwargs(dataset, variable_name, rotate=rotate, **kwargs)
+    ntime = len(dataset.time)
+    print('Looping over %i time indices'%ntime); sys.stdout.flush()
+    reader = read_slices(dataset, variable_name, range(ntime), prefetch)
+    drawn = iter_frames(dataset, variable_name, reader, rotate=rotate, samples_per_day=samples_per_day, **kwargs)
+    with AnimationWriter(outputfile, time_per_frame) as writer:
+        for n, (i, figure) in enumerate(drawn):
+            writer.append_data(get_image(figure))
+            update_progress(n+1, ntime)
+    print(reader.summary()); sys.stdout.flush()
+
+
+def animate_frames(outputfile, frames, time_per_frame=0.1):
+    # Stream frame files into the animation one at a time
     print('Stitching %i frames together...'%(len(frames)), end='')
     sys.stdout.flush()
-    images = [imageio.imread(frame) for frame in frames]
-    imageio.mimsave(outputfile, images, **kwargs)
+    with AnimationWriter(outputfile, time_per_frame) as writer:
+        for frame in frames: writer.append_data(imageio.imread(frame))
     print('Done.'); sys.stdout.flush()
 
 
@@ -151,6 +357,13 @@ def update_progress(iteration, num_iterations, bar_length=10):
 
 
 def main(variable_name, outputfile, *inputfiles, **kwargs):
+    '''
+    Animate a variable from a set of files as a GIF, MP4 or WebP. By default
+    frames are streamed directly into the animation; with stream=False or
+    workers > 1, frames are written to tmp_frames/ first (and frames already
+    there are reused), then stitched together. The next prefetch=K time
+    slices (default 2) are read in a background thread while a frame is drawn.
+    '''
 
     # Open files
     dataset = open_files(*inputfiles)
@@ -160,9 +373,16 @@ def main(variable_name, outputfile, *inputfiles, **kwargs):
     for key in ('time_per_frame',):
         if key in kwargs.keys():
             animate_kw[key] = kwargs.pop(key)
+    stream = str(kwargs.pop('stream', True)) == 'True'
+
+    if stream and int(kwargs.get('workers', 1)) <= 1:
+        # Render straight into the animation
+        for key in ('workers', 'fast'): kwargs.pop(key, None)
+        write_animation(dataset, variable_name, outputfile, **animate_kw, **kwargs)
+        return
 
     # Plot frames
-    frames = plot_frames(dataset, variable_name, **kwargs)
+    frames = plot_frames(dataset, variable_name, inputfiles=inputfiles, **kwargs)
 
     # Stitch together frames into single animation
     animate_frames(outputfile, frames, **animate_kw)
@@ -1,63 +1,444 @@
 import numpy
 import xarray
 import scipy.sparse
-import sys
+import sys, os, shutil, functools
+from concurrent.futures import ThreadPoolExecutor
+from disk_cache import get_cache_dir, file_key
 
 def myprint(*args, **kwargs):
     print(*args, **kwargs); sys.stdout.flush()
 
 
-def apply_map(da, map_file, template=None, verbose=False):
+def csr_row_block(data, indices, indptr, r0, r1, ncols):
+    '''
+    CSR matrix for rows r0:r1 of the CSR arrays (data, indices, indptr),
+    sharing memory with data and indices rather than copying them
+    '''
+    # Assign the arrays directly; the csr_matrix constructor copies slices
+    # that are small relative to the array they come from
+    p0, p1 = indptr[r0], indptr[r1]
+    block = scipy.sparse.csr_matrix((r1 - r0, ncols), dtype=data.dtype)
+    block.data, block.indices = data[p0:p1], indices[p0:p1]
+    block.indptr = numpy.asarray(indptr[r0:r1+1] - p0, dtype=indices.dtype)
+    return block
+
+
+class RemapOperator(object):
+    '''
+    Sparse remap operator built once from a mapping file. Weights are stored
+    as a CSR matrix with compact int32 indices, along with the destination
+    grid information needed to shape and label remapped output.
+    '''
+    def __init__(self, weights, dst_grid_dims, xc_b, yc_b):
+        self.weights = weights
+        self.dst_grid_dims = numpy.asarray(dst_grid_dims)
+        self.xc_b = numpy.asarray(xc_b)
+        self.yc_b = numpy.asarray(yc_b)
+        self._row_blocks = {}
+        self._row_sums = None
+
+    @property
+    def shape(self):
+        return self.weights.shape
+
+    @property
+    def dtype(self):
+        return self.weights.dtype
+
+    @classmethod
+    def from_dataset(cls, ds_map):
+        # Use grid sizes from the mapping file if available rather than
+        # inferring shape from the largest row/col index
+        if 'n_a' in ds_map.sizes and 'n_b' in ds_map.sizes:
+            shape = (ds_map.sizes['n_b'], ds_map.sizes['n_a'])
+        else:
+            shape = None
+        row = ds_map['row'].values.astype(numpy.int32) - 1
+        col = ds_map['col'].values.astype(numpy.int32) - 1
+        weights = scipy.sparse.coo_matrix((ds_map['S'].values, (row, col)), shape=shape).tocsr()
+        return cls(weights, ds_map['dst_grid_dims'].values, ds_map['xc_b'].values, ds_map['yc_b'].values)
+
+    @classmethod
+    def from_file(cls, map_file):
+        with xarray.open_dataset(map_file) as ds_map:
+            return cls.from_dataset(ds_map)
+
+    def save(self, path):
+        # Write to a temporary directory and move into place so that
+        # concurrent processes never see a partially written cache entry
+        tmp_path = f'{path}.tmp{os.getpid()}'
+        os.makedirs(tmp_path, exist_ok=True)
+        for name, value in (('data', self.weights.data),
+                            ('indices', self.weights.indices),
+                            ('indptr', self.weights.indptr),
+                            ('shape', numpy.array(self.weights.shape)),
+                            ('dst_grid_dims', self.dst_grid_dims),
+                            ('xc_b', self.xc_b),
+                            ('yc_b', self.yc_b)):
+            numpy.save(os.path.join(tmp_path, f'{name}.npy'), value)
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            # Another process beat us to it
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+    @classmethod
+    def load(cls, path):
+        # Memory-map the large arrays so loading is nearly instant
+        def _load(name, mmap_mode=None):
+            return numpy.load(os.path.join(path, f'{name}.npy'), mmap_mode=mmap_mode)
+        weights = scipy.sparse.csr_matrix(
+            (_load('data', 'r'), _load('indices', 'r'), _load('indptr', 'r')),
+            shape=tuple(_load('shape')), copy=False
+        )
+        return cls(weights, _load('dst_grid_dims'), _load('xc_b', 'r'), _load('yc_b', 'r'))
+
+    @property
+    def row_sums(self):
+        # Remapped value of a field of ones; used to measure coverage
+        if self._row_sums is None:
+            self._row_sums = numpy.asarray(self.weights.sum(axis=1)).ravel()
+        return self._row_sums
+
+    def row_blocks(self, nblocks):
+        '''
+        Split the CSR rows into contiguous blocks holding roughly equal numbers
+        of nonzero weights so that threads get balanced amounts of work. Blocks
+        are views on the operator's arrays (only indptr is shifted and copied),
+        so they add no copy of the weights, and memory-mapped weights stay on
+        disk until used.
+        '''
+        if nblocks not in self._row_blocks:
+            indptr = self.weights.indptr
+            bounds = numpy.searchsorted(indptr, numpy.linspace(0, indptr[-1], nblocks + 1))
+            bounds[0], bounds[-1] = 0, self.shape[0]
+            bounds = numpy.unique(bounds)
+            self._row_blocks[nblocks] = [
+                (r0, r1, csr_row_block(self.weights.data, self.weights.indices, indptr, r0, r1, self.shape[1]))
+                for r0, r1 in zip(bounds[:-1], bounds[1:])
+            ]
+        return self._row_blocks[nblocks]
+
+    def dot(self, x, threads=None):
+        if threads is None or int(threads) <= 1:
+            return self.weights.dot(x)
+
+        # Multi-threaded matvec over balanced row blocks; scipy's sparse
+        # kernels release the GIL so the blocks run concurrently
+        out = numpy.empty((self.shape[0],) + x.shape[1:], dtype=numpy.result_type(self.dtype, x.dtype))
+        def _dot_block(block):
+            r0, r1, weights = block
+            out[r0:r1] = weights.dot(x)
+        with ThreadPoolExecutor(int(threads)) as executor:
+            list(executor.map(_dot_block, self.row_blocks(int(threads))))
+        return out
+
+class BlockedRemapOperator(RemapOperator):
+    '''
+    Remap operator backed by memory-mapped, row-partitioned CSR arrays on
+    disk (int32 column indices, optionally float32 weights). Weights are
+    streamed one row block at a time, so memory use is proportional to a
+    single block rather than to the whole map. Use write_blocked_operator to
+    create the on-disk format from a mapping file.
+    '''
+    def __init__(self, path):
+        def _load(name, mmap_mode=None):
+            return numpy.load(os.path.join(path, f'{name}.npy'), mmap_mode=mmap_mode)
+        # No in-memory weights; blocks are read from disk when needed
+        super().__init__(None, _load('dst_grid_dims'), _load('xc_b', 'r'), _load('yc_b', 'r'))
+        self.path = path
+        self.data = _load('data', 'r')
+        self.indices = _load('indices', 'r')
+        self.indptr = _load('indptr', 'r')
+        self.row_bounds = _load('row_bounds')
+        self._shape = tuple(_load('shape'))
+
+    @classmethod
+    def load(cls, path):
+        return cls(path)
+
+    @property
+    def shape(self):
+        return self._shape
+
+    @property
+    def dtype(self):
+        return self.data.dtype
+
+    def get_block(self, r0, r1):
+        # Read one block of rows into memory as a CSR matrix
+        p0, p1 = self.indptr[r0], self.indptr[r1]
+        return scipy.sparse.csr_matrix(
+            (numpy.array(self.data[p0:p1]), numpy.array(self.indices[p0:p1]),
+             numpy.array(self.indptr[r0:r1+1] - p0)),
+            shape=(r1 - r0, self.shape[1])
+        )
+
+    def row_blocks(self, nblocks=None):
+        '''
+        Iterate over (r0, r1, weights) for the row blocks stored on disk,
+        reading each block only when it is reached. The partition is fixed
+        when the operator is written, so nblocks is ignored.
+        '''
+        return ((r0, r1, self.get_block(r0, r1)) for r0, r1 in zip(self.row_bounds[:-1], self.row_bounds[1:]))
+
+    @property
+    def row_sums(self):
+        if self._row_sums is None:
+            self._row_sums = numpy.concatenate([
+                numpy.asarray(weights.sum(axis=1)).ravel() for r0, r1, weights in self.row_blocks()
+            ])
+        return self._row_sums
+
+    def dot(self, x, threads=None):
+        # Stream over row blocks, reading each block from disk only while it
+        # is being applied; with threads > 1, that many blocks are in flight
+        out = numpy.empty((self.shape[0],) + x.shape[1:], dtype=numpy.result_type(self.dtype, x.dtype))
+        def _dot_block(bounds):
+            r0, r1 = bounds
+            out[r0:r1] = self.get_block(r0, r1).dot(x)
+        blocks = list(zip(self.row_bounds[:-1], self.row_bounds[1:]))
+        if threads is None or int(threads) <= 1:
+            for block in blocks: _dot_block(block)
+        else:
+            with ThreadPoolExecutor(int(threads)) as executor:
+                list(executor.map(_dot_block, blocks))
+        return out
+
+
+def write_blocked_operator(map_file, path, block_nnz=2**24, weight_dtype=numpy.float64,
+                           chunk_size=2**24, verbose=False):
+    '''
+    Convert the S/row/col weights in a mapping file to the memory-mapped,
+    row-partitioned format read by BlockedRemapOperator. The COO weights are
+    read chunk_size entries at a time and scattered into CSR order on disk,
+    so the conversion itself never holds the full map in memory.
+    '''
+    from numpy.lib.format import open_memmap
+    tmp_path = f'{path}.tmp{os.getpid()}'
+    os.makedirs(tmp_path, exist_ok=True)
+    with xarray.open_dataset(map_file) as ds_map:
+        n_s = ds_map.sizes['n_s']
+        if 'n_a' in ds_map.sizes and 'n_b' in ds_map.sizes:
+            n_a, n_b = ds_map.sizes['n_a'], ds_map.sizes['n_b']
+        else:
+            n_a, n_b = int(ds_map['col'].max()), int(ds_map['row'].max())
+        chunks = [(i0, min(i0 + chunk_size, n_s)) for i0 in range(0, n_s, chunk_size)]
+
+        # First pass: count weights per destination row to build indptr
+        if verbose: myprint('Count weights per row')
+        counts = numpy.zeros(n_b, dtype=numpy.int64)
+        for i0, i1 in chunks:
+            counts += numpy.bincount(ds_map['row'][i0:i1].values - 1, minlength=n_b)
+        indptr = numpy.zeros(n_b + 1, dtype=numpy.int64)
+        numpy.cumsum(counts, out=indptr[1:])
+
+        # Second pass: scatter each chunk of weights into CSR order
+        if verbose: myprint('Scatter weights into CSR order')
+        indices = open_memmap(os.path.join(tmp_path, 'indices.npy'), mode='w+', dtype=numpy.int32, shape=(n_s,))
+        data = open_memmap(os.path.join(tmp_path, 'data.npy'), mode='w+', dtype=weight_dtype, shape=(n_s,))
+        filled = indptr[:-1].copy()
+        for i0, i1 in chunks:
+            row = ds_map['row'][i0:i1].values.astype(numpy.int64) - 1
+            order = numpy.argsort(row, kind='stable')
+            row = row[order]
+            # Position of each entry among the entries for the same row
+            first = numpy.searchsorted(row, row, side='left')
+            dest = filled[row] + numpy.arange(len(row)) - first
+            indices[dest] = ds_map['col'][i0:i1].values[order] - 1
+            data[dest] = ds_map['S'][i0:i1].values[order]
+            filled += numpy.bincount(row, minlength=n_b)
+        indices.flush(); data.flush()
+        del indices, data
+
+        # Split rows into blocks holding roughly block_nnz weights each
+        nblocks = max(1, int(numpy.ceil(n_s / block_nnz)))
+        row_bounds = numpy.unique(numpy.concatenate((
+            [0], numpy.searchsorted(indptr, numpy.arange(1, nblocks) * block_nnz), [n_b]
+        )))
+
+        for name, value in (('indptr', indptr),
+                            ('row_bounds', row_bounds),
+                            ('shape', numpy.array((n_b, n_a))),
+                            ('dst_grid_dims', ds_map['dst_grid_dims'].values),
+                            ('xc_b', ds_map['xc_b'].values),
+                            ('yc_b', ds_map['yc_b'].values)):
+            numpy.save(os.path.join(tmp_path, f'{name}.npy'), value)
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+    return path
+
+
+@functools.lru_cache(maxsize=8)
+def _get_remap_operator(map_file, key, use_disk_cache, blocked, weight_dtype):
+    if blocked:
+        suffix = 'blocked' if weight_dtype == 'float64' else f'blocked_{weight_dtype}'
+        cache_path = os.path.join(get_cache_dir('remap_operators'), f'{key}.{suffix}')
+        if not os.path.isdir(cache_path):
+            write_blocked_operator(map_file, cache_path, weight_dtype=weight_dtype)
+        return BlockedRemapOperator.load(cache_path)
+    if use_disk_cache:
+        cache_path = os.path.join(get_cache_dir('remap_operators'), key)
+        if os.path.isdir(cache_path):
+            return RemapOperator.load(cache_path)
+    operator = RemapOperator.from_file(map_file)
+    if use_disk_cache:
+        operator.save(cache_path)
+    return operator
 
-    # Allow for passing either a mapping file name or a xarray.Dataset
-    if isinstance(map_file, xarray.Dataset):
-        ds_map = map_file
+
+def get_remap_operator(map_file, use_disk_cache=True, blocked=False, weight_dtype=numpy.float64):
+    '''
+    Return the remap operator for a mapping file, building it only once per
+    process and caching it on disk keyed by the file's path, size and mtime.
+    With blocked=True the map is converted to the row-partitioned on-disk
+    format (with weights stored as weight_dtype, e.g. float32 to halve its
+    size) and streamed block by block when applied. A directory written by
+    write_blocked_operator may also be passed directly.
+    '''
+    if os.path.isdir(map_file):
+        return BlockedRemapOperator.load(map_file)
+    return _get_remap_operator(
+        os.path.abspath(map_file), file_key(map_file), use_disk_cache, blocked,
+        numpy.dtype(weight_dtype).name
+    )
+
+
+def apply_map(da, map_file, template=None, threads=None,
+              masked=False, fill_value=None, min_coverage=0,
+              blocked=False, weight_dtype=numpy.float64, verbose=False):
+    '''
+    Remap a DataArray using the weights from a mapping file. If the data is
+    dask-backed the result stays lazy, with the sparse operator applied
+    independently to each chunk along the non-spatial dimensions. Set
+    threads to split the sparse matrix product across a thread pool.
+
+    With masked=True, NaNs (and fill_value, if given) in the source field are
+    excluded from the remap and destination values are renormalized by the
+    remapped valid fraction; destination cells whose valid coverage is below
+    min_coverage are set to NaN.
+
+    With blocked=True a mapping file is applied from the row-partitioned,
+    memory-mapped format (see get_remap_operator), with weights stored as
+    weight_dtype.
+    '''
+
+    # Allow for passing either a mapping file name, a xarray.Dataset, or a
+    # prebuilt RemapOperator
+    if isinstance(map_file, RemapOperator):
+        operator = map_file
+    elif isinstance(map_file, xarray.Dataset):
+        if verbose: myprint('Create weights from xarray.Dataset object')
+        operator = RemapOperator.from_dataset(map_file)
     else:
-        if verbose: myprint('Open map file as xarray.Dataset object')
-        ds_map = xarray.open_mfdataset(map_file)
-
-    # Do the remapping
-    if verbose: myprint('Create weights as a COO matrix')
-    weights = scipy.sparse.coo_matrix((ds_map['S'].values, (ds_map['row'].values-1, ds_map['col'].values-1)))
-    if verbose: myprint('Flatten data array')
-    if len(da.shape) == 1:
-        da_flat = da.data
-    elif len(da.shape) == 2:
-        da_flat = da.data.reshape([da.shape[0]*da.shape[1]])
+        if verbose: myprint('Get cached remap operator for map file')
+        operator = get_remap_operator(map_file, blocked=blocked, weight_dtype=weight_dtype)
+
+    # Figure out destination dimensions and coordinates
+    if template is not None:
+        dst_dims = template.dims
+        dst_shape = template.shape
+        dst_coords = template.coords
+    elif len(operator.dst_grid_dims) == 2:
+        # Get lon and lat coordinates from mapping file
+        x = operator.xc_b.reshape(operator.dst_grid_dims[::-1])[0,:]
+        y = operator.yc_b.reshape(operator.dst_grid_dims[::-1])[:,0]
+        dst_dims = ('lat', 'lon')
+        dst_shape = tuple(operator.dst_grid_dims[::-1])
+        dst_coords = {'lat': y, 'lon': x}
+    else:
+        x = xarray.DataArray(operator.xc_b, dims=('ncol',))
+        y = xarray.DataArray(operator.yc_b, dims=('ncol',))
+        dst_dims = ('ncol',)
+        dst_shape = (operator.shape[0],)
+        dst_coords = {}
+
+    # Source grid dimensions are the core dimensions of the remap; rename them
+    # if they clash with the destination dimensions (e.g., ncol to ncol), and
+    # make sure they are not split across dask chunks
+    src_dims = get_src_dims(da, operator.shape[1])
+    rename = {d: f'{d}_src' for d in src_dims if d in dst_dims}
+    da = da.rename(rename)
+    src_dims = tuple(rename.get(d, d) for d in src_dims)
+    if da.chunks is not None:
+        if verbose: myprint('Remap lazily over dask chunks')
+        da = da.chunk({d: -1 for d in src_dims})
+
+    # Apply weights; all other dimensions (e.g., time and lev) are flattened
+    # into a single batch so each chunk is remapped with one sparse x dense
+    # matrix product
     if verbose: myprint('Apply weights via matrix multiply')
-    da_regrid = weights.dot(da_flat)
-
-    # Figure out coordinate variables and whether or not we should reshape the
-    # output before returning
-    if verbose: myprint('Reshape output')
-    if isinstance(template, xarray.DataArray):
-        da_regrid = xarray.DataArray(
-            da_regrid.reshape(template.shape), dims=template.dims, coords=template.coords,
-            attrs=da.attrs
-        )
+    da_regrid = xarray.apply_ufunc(
+        remap_array, da,
+        kwargs={'operator': operator, 'dst_shape': dst_shape, 'src_ndim': len(src_dims), 'threads': threads,
+                'masked': masked, 'fill_value': fill_value, 'min_coverage': float(min_coverage)},
+        input_core_dims=[src_dims], output_core_dims=[dst_dims],
+        dask='parallelized',
+        output_dtypes=[numpy.result_type(da.dtype, operator.dtype, numpy.float64)],
+        dask_gufunc_kwargs={'output_sizes': dict(zip(dst_dims, dst_shape))},
+        keep_attrs=True,
+    ).assign_coords(dst_coords)
+
+    # Coordinates on the destination grid
+    if template is not None:
         x = da_regrid.lon
         y = da_regrid.lat
-    elif len(ds_map.dst_grid_dims) == 2:
-        # Get lon and lat coordinates from mapping file
-        x = ds_map.xc_b.values.reshape(ds_map.dst_grid_dims.values[::-1])[0,:]
-        y = ds_map.yc_b.values.reshape(ds_map.dst_grid_dims.values[::-1])[:,0]
-
-        # Reshape to expected output
-        da_regrid = xarray.DataArray(
-            da_regrid.reshape(ds_map.dst_grid_dims.values[::-1]),
-            dims=('lat', 'lon'),
-            coords={'lat': y, 'lon': x},
-            attrs=da.attrs,
-        )
-    else:
-        x = ds_map.xc_b
-        y = ds_map.yc_b
 
     # Return remapped array and coordinate variables
     if verbose: myprint('Return remapped data, x, y')
     return da_regrid, x, y
 
 
+def remap_array(data, operator, dst_shape, src_ndim=1, threads=None,
+                masked=False, fill_value=None, min_coverage=0):
+    '''
+    Apply a remap operator to an array whose trailing dimension(s) span the
+    source grid, remapping all leading slices at once as W @ X[n_a, nbatch]
+    '''
+    n_a = operator.shape[1]
+    batch_shape = data.shape[:data.ndim - src_ndim]
+    data_flat = data.reshape([-1, n_a])
+    if not masked:
+        data_flat = numpy.ascontiguousarray(data_flat.T)
+        return operator.dot(data_flat, threads=threads).T.reshape(batch_shape + tuple(dst_shape))
+
+    # Remap the zero-filled field and the valid mask together in one sparse
+    # product by stacking them as extra columns, then renormalize
+    valid = numpy.isfinite(data_flat)
+    if fill_value is not None: valid &= (data_flat != fill_value)
+    nbatch = data_flat.shape[0]
+    stacked = numpy.empty((n_a, 2 * nbatch))
+    stacked[:, :nbatch] = numpy.where(valid, data_flat, 0).T
+    stacked[:, nbatch:] = valid.T
+    remapped = operator.dot(stacked, threads=threads)
+    data_remap, frac_remap = remapped[:, :nbatch], remapped[:, nbatch:]
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        coverage = frac_remap / operator.row_sums[:, None]
+        data_remap = numpy.where(
+            (frac_remap > 0) & (coverage >= min_coverage),
+            data_remap / frac_remap * operator.row_sums[:, None], numpy.nan
+        )
+    return data_remap.T.reshape(batch_shape + tuple(dst_shape))
+
+
+def get_src_dims(da, n_a):
+    '''
+    Find the dimension(s) of a DataArray that span the source grid of a map
+    with n_a source points: either a single unstructured dimension (e.g.,
+    ncol) or a pair of logically rectangular dimensions (e.g., lat, lon).
+    '''
+    if 'ncol' in da.dims and da.sizes['ncol'] == n_a:
+        return ('ncol',)
+    for d in da.dims[::-1]:
+        if da.sizes[d] == n_a:
+            return (d,)
+    if len(da.dims) >= 2 and da.shape[-2] * da.shape[-1] == n_a:
+        return da.dims[-2:]
+    raise ValueError(f'Dimensions {da.dims} with shape {da.shape} do not match map source grid size {n_a}')
+
+
 # update_progress() : Displays or updates a console progress bar
 def update_progress(iteration, num_iterations, bar_length=10):
     '''
@@ -86,31 +467,64 @@ def update_progress(iteration, num_iterations, bar_length=10):
     sys.stdout.flush()
 
 
-def interp_along_axis(xout, xin, yin, axis=0, *args, **kwargs):
+def interp_along_axis(xout, xin, yin, axis=0, left=None, right=None, log=False, block_size=2**16):
     """
     Perform 1D interpolation along 1D slices of a ND array.
+
+    Equivalent to applying numpy.interp(xout, xin, yin, left, right) to every
+    1D slice along axis, but vectorized over all slices at once (in blocks of
+    block_size slices to bound memory). Each slice of xin may be monotonically
+    increasing or decreasing. Set log=True to interpolate in log(x) (e.g.,
+    log-pressure), and left=right=numpy.nan to get NaN outside the range of xin.
     """
 
     # Make sure input arrays are sized appropriately
-    assert xin.shape == yin.shape
-
-    # Setup output array
-    shape_in  = yin.shape
-    shape_out = list(shape_in)
-    shape_out[axis] = len(xout)
-    yout = numpy.empty(shape_out)
-
-    # Apply function along axis specified by looping over
-    # indices across the other axes and applying function
-    # to 1d slices; equivalent to, e.g.,
-    # for ii in yin.shape[0]:
-    #     for jj in yin.shape[1]:
-    #        for kk in yin.shape[2]:
-    #            yout[ii,jj,kk,:] = numpy.interp(xout, xin[ii,jj,kk,:], yin[ii,jj,kk,:])
-    Ni, Nk = yin.shape[:axis], yin.shape[axis+1:]
-    for ii in numpy.ndindex(Ni):
-        for kk in numpy.ndindex(Nk):
-            yout[ii + numpy.s_[...,] + kk] = numpy.interp(
-                xout, xin[ii + numpy.s_[:,] + kk], yin[ii + numpy.s_[:,] + kk], *args, **kwargs
-            )
-    return yout
+    xin = numpy.broadcast_to(xin, yin.shape)
+    xout = numpy.asarray(xout, dtype=numpy.float64)
+
+    # Move interpolation axis to the end and flatten the rest so that each
+    # row is one 1D slice
+    xin_flat = numpy.moveaxis(xin, axis, -1).reshape(-1, yin.shape[axis]).astype(numpy.float64)
+    yin_flat = numpy.moveaxis(yin, axis, -1).reshape(-1, yin.shape[axis]).astype(numpy.float64)
+    if log:
+        xin_flat, xout = numpy.log(xin_flat), numpy.log(xout)
+    yout_flat = numpy.empty((xin_flat.shape[0], len(xout)))
+
+    nin = xin_flat.shape[1]
+    for i0 in range(0, xin_flat.shape[0], block_size):
+        x = xin_flat[i0:i0+block_size]
+        y = yin_flat[i0:i0+block_size]
+
+        # Flip decreasing slices so that all are increasing
+        decreasing = x[:, 0] > x[:, -1]
+        x = numpy.where(decreasing[:, None], x[:, ::-1], x)
+        y = numpy.where(decreasing[:, None], y[:, ::-1], y)
+
+        # Index of the interval containing each output point, found for all
+        # slices at once by counting input points at or below it
+        j = numpy.clip(numpy.sum(x[:, :, None] <= xout[None, None, :], axis=1) - 1, 0, max(nin - 2, 0))
+        x0 = numpy.take_along_axis(x, j, axis=1)
+        y0 = numpy.take_along_axis(y, j, axis=1)
+        if nin > 1:
+            x1 = numpy.take_along_axis(x, j + 1, axis=1)
+            y1 = numpy.take_along_axis(y, j + 1, axis=1)
+            with numpy.errstate(divide='ignore', invalid='ignore'):
+                slope = (y1 - y0) / (x1 - x0)
+                yout = slope * (xout[None, :] - x0) + y0
+            # Exact matches on an interval end as in numpy.interp
+            yout = numpy.where(xout[None, :] == x1, y1, yout)
+            yout = numpy.where(xout[None, :] == x0, y0, yout)
+        else:
+            yout = y0
+
+        # Values outside the range of xin
+        below = xout[None, :] < x[:, :1]
+        above = xout[None, :] > x[:, -1:]
+        yout = numpy.where(below, y[:, :1] if left is None else left, yout)
+        yout = numpy.where(above, y[:, -1:] if right is None else right, yout)
+        yout_flat[i0:i0+block_size] = yout
+
+    # Restore original dimension order
+    shape_out = list(numpy.moveaxis(yin, axis, -1).shape)
+    shape_out[-1] = len(xout)
+    return numpy.moveaxis(yout_flat.reshape(shape_out), -1, axis)
@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+import plac, os, numpy, scipy.sparse
+from time import perf_counter
+from apply_map import RemapOperator, myprint
+
+
+def make_operator(n_a, n_b, nnz_per_row, seed=0):
+    '''
+    Build a synthetic remap operator with a fixed number of weights per
+    destination row, mimicking a high-resolution to lat/lon map
+    '''
+    rng = numpy.random.default_rng(seed)
+    indptr = numpy.arange(0, (n_b + 1) * nnz_per_row, nnz_per_row, dtype=numpy.int64)
+    indices = rng.integers(0, n_a, n_b * nnz_per_row, dtype=numpy.int32)
+    indices.reshape(n_b, nnz_per_row).sort(axis=1)
+    data = rng.random(n_b * nnz_per_row)
+    weights = scipy.sparse.csr_matrix((data, indices, indptr), shape=(n_b, n_a))
+    return RemapOperator(weights, [n_b], numpy.zeros(n_b), numpy.zeros(n_b))
+
+
+def time_dot(operator, x, threads, repeat):
+    operator.dot(x, threads=threads)  # warm up and build row blocks
+    t0 = perf_counter()
+    for i in range(repeat): operator.dot(x, threads=threads)
+    return (perf_counter() - t0) / repeat
+
+
+def main(n_a=25165824, n_b=1038240, nnz_per_row=16, nbatch=4, repeat=3, max_threads=None):
+    '''
+    Time the remap matvec for increasing thread counts and report speedup
+    relative to a single thread. Default sizes are an ne1024pg2 source grid
+    (6 x 2048 x 2048 columns) and a 0.25 degree (721 x 1440) lat/lon grid.
+    '''
+    n_a, n_b, nnz_per_row, nbatch, repeat = map(int, (n_a, n_b, nnz_per_row, nbatch, repeat))
+    max_threads = os.cpu_count() if max_threads is None else int(max_threads)
+    myprint(f'Build operator: n_a = {n_a}; n_b = {n_b}; nnz = {n_b*nnz_per_row}; nbatch = {nbatch}')
+    operator = make_operator(n_a, n_b, nnz_per_row)
+    x = numpy.random.default_rng(1).random((n_a, nbatch)) if nbatch > 1 else numpy.random.default_rng(1).random(n_a)
+
+    # Check that threaded results agree with the serial kernel
+    assert numpy.allclose(operator.dot(x), operator.dot(x, threads=max_threads))
+
+    # Time with powers of two threads up to max_threads
+    thread_counts = sorted(set([2**i for i in range(int(numpy.log2(max_threads)) + 1)] + [max_threads]))
+    myprint(f'{"threads":>8} {"time (s)":>10} {"speedup":>8} {"GB/s":>8}')
+    nbytes = operator.weights.data.nbytes + operator.weights.indices.nbytes + x.nbytes
+    t_serial = None
+    for threads in thread_counts:
+        t = time_dot(operator, x, threads, repeat)
+        if t_serial is None: t_serial = t
+        myprint(f'{threads:>8} {t:>10.4f} {t_serial / t:>8.2f} {nbytes / t / 1e9:>8.2f}')
+
+
+if __name__ == '__main__':
+    plac.call(main)
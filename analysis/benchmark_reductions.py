@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+import plac, os, shutil, tempfile, numpy, xarray
+from time import perf_counter
+from apply_map import myprint
+import disk_cache
+from reduction_store import reduce_files
+
+
+def make_files(directory, nfiles, ntimes, ncol, nfields, seed=0):
+    '''
+    Write a synthetic stream of nfiles files, each with ntimes time samples of
+    nfields (time, ncol) fields plus lon, lat and area
+    '''
+    rng = numpy.random.default_rng(seed)
+    lon = rng.uniform(0, 360, ncol)
+    lat = numpy.degrees(numpy.arcsin(rng.uniform(-1, 1, ncol)))
+    area = numpy.full(ncol, 4 * numpy.pi / ncol)
+    files = []
+    for i in range(nfiles):
+        time = xarray.cftime_range('1994-10-01', periods=nfiles * ntimes, freq='h')[i*ntimes:(i+1)*ntimes]
+        ds = xarray.Dataset(
+            {f'field{j}': (('time', 'ncol'), rng.normal(size=(ntimes, ncol)).astype(numpy.float32), {'long_name': f'field {j}', 'units': '1'})
+             for j in range(nfields)},
+            coords={'time': time, 'lon': ('ncol', lon), 'lat': ('ncol', lat), 'area': ('ncol', area)},
+        )
+        files.append(os.path.join(directory, f'output.scream.benchmark.{time[0].strftime("%Y-%m-%d")}-{3600*time[0].hour:05d}.nc'))
+        ds.to_netcdf(files[-1])
+    return files
+
+
+def main(ne=120, nfiles=32, ntimes=4, nfields=8, max_workers=None):
+    '''
+    Time reduce_files on a synthetic ne{ne}pg2 stream (6 x 4 x ne**2 columns)
+    for increasing worker counts, and check that results do not depend on the
+    number of workers. Files are read once before timing, so this measures
+    throughput with the files in the page cache.
+    '''
+    ne, nfiles, ntimes, nfields = map(int, (ne, nfiles, ntimes, nfields))
+    max_workers = os.cpu_count() if max_workers is None else int(max_workers)
+    ncol = 6 * 4 * ne**2
+    directory = tempfile.mkdtemp()
+    # Keep the reduction store for the synthetic files out of the real cache
+    disk_cache.cache_root = os.path.join(directory, 'cache')
+    try:
+        myprint(f'Write {nfiles} files: ncol = {ncol}; ntimes = {ntimes}; nfields = {nfields}')
+        files = make_files(directory, nfiles, ntimes, ncol, nfields)
+        nbytes = sum(os.path.getsize(f) for f in files)
+        reference = reduce_files(files)
+
+        worker_counts = sorted(set([2**i for i in range(int(numpy.log2(max_workers)) + 1)] + [max_workers]))
+        myprint(f'{"workers":>8} {"time (s)":>10} {"speedup":>8} {"MB/s":>8}')
+        t_serial = None
+        for workers in worker_counts:
+            t0 = perf_counter()
+            reductions, time_means = reduce_files(files, workers=workers)
+            t = perf_counter() - t0
+            xarray.testing.assert_identical(reductions, reference[0])
+            xarray.testing.assert_identical(time_means, reference[1])
+            if t_serial is None: t_serial = t
+            myprint(f'{workers:>8} {t:>10.4f} {t_serial / t:>8.2f} {nbytes / t / 1e6:>8.1f}')
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    plac.call(main)
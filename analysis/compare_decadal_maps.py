@@ -8,8 +8,10 @@ from matplotlib import pyplot
 #from e3smplot.mpl.compare_maps import main as compare_maps
 from compare_maps import main as compare_maps
 from e3smplot.mpl.plot_maps import main as plot_maps
+from run_catalog import Catalog
 from e3smplot.e3sm_utils import get_data, get_grid_name
-from e3smplot.e3sm_utils import get_scrip_grid, get_mapping_file
+from e3smplot.e3sm_utils import get_scrip_grid
+from make_map import get_map_file
 from cartopy import crs
 
 case = 'run3-adios'
@@ -40,6 +42,11 @@ ceres_vars = (
         'toa_sw_all_clim', 'toa_sw_clr_t_clim',
         'toa_lw_all_clim', 'toa_lw_clr_t_clim',
     )
+# Index the run directory; only files that are new or have changed since the
+# last refresh are opened
+catalog = Catalog(rundir)
+catalog.refresh()
+
 # Find output streams
 print('Find output streams'); sys.stdout.flush()
 #output_streams = [os.path.basename(f).replace('.1994-10-01-00000.nc', '') for f in glob(f'{rundir}/output.scream.decadal.*.1994-10-01-00000.nc')]
@@ -55,12 +62,11 @@ for output_stream in output_streams:
 
     # Find files
     print('Find files'); sys.stdout.flush()
-    files = sorted(glob(f'{rundir}/{output_stream}.????-??-??-?????.nc'))
+    files = catalog.files(output_stream)
 
     # Get list of fields to plot; we will plot all the 2D fields
     print('Find fields in files'); sys.stdout.flush()
-    with xarray.open_mfdataset(files, use_cftime=True, data_vars='minimal', coords='minimal', compat='override') as ds:
-        fields = [v for v in ds.variables.keys() if ds[v].dims == ('time', 'ncol')]
+    fields = catalog.fields(output_stream)
 
     # Get grid file
     print('Find model grid file'); sys.stdout.flush()
@@ -88,7 +94,7 @@ for output_stream in output_streams:
 
         # Get map from model to obs
         print('Get map file'); sys.stdout.flush()
-        mapfile = get_mapping_file(files[0], obsfiles, mapping_root, method='fv2fv') 
+        mapfile = get_map_file(modgrid, obsgrid, mapping_root, method='fv2fv')
 
         # Make plots
         figname = f'{plotdir}/maps/{v}.map.{output_stream}_vs_{obs_name}.png'
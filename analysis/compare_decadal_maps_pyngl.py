@@ -1,11 +1,11 @@
 #!/usr/bin/env python3
 
-import xarray
 from glob import glob
 import sys, os
 #from plot_map_pyngl import main as plot_map
 from compare_maps_pyngl import main as compare_maps
 from plot_maps_pyngl import main as plot_maps
+from run_catalog import Catalog
 from e3smplot.e3sm_utils import get_data, get_grid_name
 from e3smplot.e3sm_utils import get_scrip_grid, get_mapping_file
 
@@ -15,9 +15,14 @@ rundir = '/global/cfs/cdirs/e3smdata/simulations/scream-decadal/decadal-producti
 obsdir = '/global/cfs/cdirs/e3smdata/observations/era5'
 mapdir = '/global/cfs/cdirs/e3sm/bhillma/maps'
 
+# Index the run directory; only files that are new or have changed since the
+# last refresh are opened
+catalog = Catalog(rundir)
+catalog.refresh()
+
 # Find output streams
 print('Find output streams'); sys.stdout.flush()
-output_streams = [os.path.basename(f).replace('.1994-10-01-00000.nc', '') for f in glob(f'{rundir}/*.1994-10-01-00000.nc')]
+output_streams = catalog.streams()
 #output_stream = 'output.scream.decadal.1dailyMAX_ne1024pg2.MAX.ndays_x1' #'output.scream.decadal.monthlyAVG_ne30pg2.AVERAGE.nmonths_x1'
 #'output.scream.decadal.6hourlyINST_ne1024pg2.INSTANT.nhours_x6', 'output.scream.decadal.15minINST_ARM.INSTANT.nmins_x15', 'output.scream.decadal.1hourlyINST_ne1024pg2.INSTANT.nhours_x1', 'output.scream.decadal.monthlyAVG_ne30pg2.AVERAGE.nmonths_x1', 'output.scream.decadal.3hourlyAVG_ne30pg2.AVERAGE.nhours_x3', 'output.scream.decadal.1dailyMIN_ne1024pg2.MIN.ndays_x1', 'output.scream.decadal.6hourlyINST_ne30pg2.INSTANT.nhours_x6', 'output.scream.decadal.6hourlyAVG_ne30pg2.AVERAGE.nhours_x6', 'decadal-production-20240305.ne1024pg2_ne1024pg2.F20TR-SCREAMv1.run1.elm.h1', 'output.scream.decadal.3hourlyINST_ne30pg2.INSTANT.nhours_x3', 'output.scream.decadal.1hourlyINST_ARM.INSTANT.nhours_x1', 'output.scream.decadal.1dailyMAX_ne1024pg2.MAX.ndays_x1', 'output.scream.decadal.1dailyAVG_ne1024pg2.AVERAGE.ndays_x1'
 output_streams = ('output.scream.decadal.monthlyAVG_ne30pg2.AVERAGE.nmonths_x1',)
@@ -29,12 +34,11 @@ for output_stream in output_streams:
 
     # Find files
     print('Find files'); sys.stdout.flush()
-    files = sorted(glob(f'{rundir}/{output_stream}.????-??-??-?????.nc'))
+    files = catalog.files(output_stream)
 
     # Get list of fields to plot; we will plot all the 2D fields
     print('Find fields in files'); sys.stdout.flush()
-    with xarray.open_mfdataset(files, data_vars='minimal', coords='minimal', compat='override') as ds:
-        fields = [v for v in ds.variables.keys() if ds[v].dims == ('time', 'ncol')]
+    fields = catalog.fields(output_stream)
 
     # Get grid file
     print('Find model grid file'); sys.stdout.flush()
@@ -1,22 +1,22 @@
 #!/usr/bin/env python3
-import plac, numpy, warnings, xarray
+import plac, xarray
 from matplotlib import pyplot
-from matplotlib.tri import Triangulation
 from cartopy import crs
 from cartopy.util import add_cyclic_point
 from time import perf_counter
-from scipy.interpolate import griddata
 from plot_map import plot_map
-from e3smplot.plot_utils import area_average
 from e3smplot.e3sm_utils import get_data, get_area_weights
 #from e3smplot.utils import apply_map, myprint
-from apply_map import apply_map, myprint
+from apply_map import apply_map, get_remap_operator, myprint
+from stream_stats import get_stats
+from stream_index import open_stream
 
 def compare_maps(coords, data_arrays, labels, figsize=None, cb_kwargs=None, **kwargs):
     
     figure, axes = pyplot.subplots(len(data_arrays)+1, 1, figsize=figsize)
-    vmin = min([d.min().values for d in data_arrays])
-    vmax = max([d.max().values for d in data_arrays])
+    stats = get_stats(*data_arrays)
+    vmin = min([s.min for s in stats])
+    vmax = max([s.max for s in stats])
     for i, ((x, y), d, l) in enumerate(zip(coords, data_arrays, labels)):
         
         # Plot full fields
@@ -38,7 +38,8 @@ def compare_maps(coords, data_arrays, labels, figsize=None, cb_kwargs=None, **kw
             d_diff = d - d_cntl
             d_diff.attrs = d.attrs
             #d_diff.attrs['long_name'] = 'Difference'
-            dmax = abs(d_diff).max().values
+            diff_stats, = get_stats(d_diff)
+            dmax = max(abs(diff_stats.min), abs(diff_stats.max))
             pl = plot_map(x, y, d_diff, cmap='bwr', vmin=-dmax, vmax=dmax,
                     cb_kwargs=cb_kwargs, **kwargs)
             ax.set_title(f'Difference')
@@ -47,7 +48,7 @@ def compare_maps(coords, data_arrays, labels, figsize=None, cb_kwargs=None, **kw
     return figure
 
 def open_dataset(*inputfiles):
-    return xarray.open_mfdataset(inputfiles, use_cftime=True, data_vars='minimal', coords='minimal', compat='override')
+    return open_stream(*inputfiles)
 
 def main(varnames, outputfile, testfiles, cntlfiles,
          t_indices=(None, None), mapfiles=None, percentile=5, verbose=False, **kwargs):
@@ -81,13 +82,13 @@ def main(varnames, outputfile, testfiles, cntlfiles,
     #
     if verbose: myprint('Remap to lat/lon grid if needed...')
     if mapfiles is not None:
-        map_datasets = [xarray.open_dataset(f) if f is not None else None for f in mapfiles]
+        map_operators = [get_remap_operator(f) if f is not None else None for f in mapfiles]
         area_arrays, lons, lats = zip(*[apply_map(m, f) if f is not
                                    None else (m, x, y) for (m, x, y, f) in
-                                   zip(area_arrays, lons, lats, map_datasets)])
-        data_arrays, lons, lats = zip(*[apply_map(m, f) if f is not
+                                   zip(area_arrays, lons, lats, map_operators)])
+        data_arrays, lons, lats = zip(*[apply_map(m, f, masked=True) if f is not
                                    None else (m, x, y) for (m, x, y, f) in
-                                   zip(data_arrays, lons, lats, map_datasets)])
+                                   zip(data_arrays, lons, lats, map_operators)])
     #
     # Compute differences
     #
@@ -112,10 +113,16 @@ def main(varnames, outputfile, testfiles, cntlfiles,
     if verbose: myprint('Make plots...')
     figure, axes = pyplot.subplots(len(data_arrays), 1, figsize=(8, 5*len(data_arrays)), subplot_kw=dict(projection=crs.PlateCarree(central_longitude=180)))
     cmaps = ['viridis', 'viridis', 'RdBu_r']
-    vmin = min([numpy.nanpercentile(da.values, percentile) for da in data_arrays[:-1]])
-    vmax = max([numpy.nanpercentile(da.values, 100-percentile) for da in data_arrays[:-1]])
-    vmins = [vmin, vmin, -abs(data_arrays[-1].max().values)]
-    vmaxs = [vmax, vmax,  abs(data_arrays[-1].max().values)]
+    #
+    # Min, max, mean and percentiles for all three panels in one pass
+    #
+    if verbose: myprint('Compute statistics...')
+    stats = get_stats(*data_arrays, weights=list(area_arrays))
+    vmin = min([s.percentile(percentile) for s in stats[:-1]])
+    vmax = max([s.percentile(100-percentile) for s in stats[:-1]])
+    dmax = max(abs(stats[-1].min), abs(stats[-1].max))
+    vmins = [vmin, vmin, -dmax]
+    vmaxs = [vmax, vmax,  dmax]
     plots = [
         plot_map(lons[i], lats[i], data_arrays[i], axes=axes[i], cmap=cmaps[i], vmin=vmins[i], vmax=vmaxs[i], **kwargs)
         for i in range(len(data_arrays))
@@ -127,12 +134,9 @@ def main(varnames, outputfile, testfiles, cntlfiles,
     #
     if verbose: myprint('Annotate plots...')
     for i in range(len(data_arrays)):
-        with warnings.catch_warnings():
-            warnings.simplefilter('ignore')
-            data_mean = area_average(data_arrays[i], area_arrays[i])
         label = labels[i]
         axes[i].set_title(
-            f'{label}\nmin = {data_arrays[i].min().values:.2f}; max = {data_arrays[i].max().values:.2f}; mean = {data_mean.values:.2f}'
+            f'{label}\nmin = {stats[i].min:.2f}; max = {stats[i].max:.2f}; mean = {stats[i].mean:.2f}'
         )
     #
     # Save figure
@@ -1,23 +1,26 @@
 #!/usr/bin/env python3
 
 import xarray, ngl, os, sys
-from e3smplot.e3sm_utils import get_data, get_area_weights, area_average
+from e3smplot.e3sm_utils import get_data, get_area_weights
 from plot_map_pyngl import plot_map
 from e3smplot.utils import nice_cntr_levels, apply_map
+from stream_stats import get_stats
 
-def compare_maps(wks, xcoords, ycoords, data_arrays, labels=None, **kwargs):
+def compare_maps(wks, xcoords, ycoords, data_arrays, labels=None, stats=None, **kwargs):
 
-    # remap or whatever
+    # Contour levels from the data range; stats (from get_stats) may be passed
+    # in if the caller already has them
+    if stats is None: stats = get_stats(*data_arrays)
     if 'clevels' not in kwargs.keys():
-        vmin = min(da.min().values for da in data_arrays[:-1])
-        vmax = max(da.max().values for da in data_arrays[:-1])
+        vmin = min(s.min for s in stats[:-1])
+        vmax = max(s.max for s in stats[:-1])
         *_, clevels = nice_cntr_levels(vmin, vmax, outside=True, max_steps=15, cint=None,
                          returnLevels=True, aboutZero=False)
         kwargs['clevels'] = clevels
     else:
         kwargs['clevels'] = kwargs['clevels'].split(',')
     if 'dlevels' not in kwargs.keys():
-        vmax = abs(data_arrays[-1]).max().values
+        vmax = max(abs(stats[-1].min), abs(stats[-1].max))
         vmin = -vmax
         *_, dlevels = nice_cntr_levels(vmin, vmax, outside=True, max_steps=15, cint=None,
                          returnLevels=True, aboutZero=True)
@@ -126,16 +129,18 @@ def main(vnames, plotname, testfiles, cntlfiles, gridfiles=(None, None),
         os.path.splitext(plotname)[0]
     )
 
-    # Append title strings
+    # Append title strings; one pass gives min, max and mean for every panel
+    # and is reused for the contour levels
     print('Compute min/maxes for title'); sys.stdout.flush()
-    labels = [f'foo' #min = {da.min().values:.02f}; max = {da.max().values:.02f}; mean = {area_average(da, wgt).values:.02f}'
-              for da, wgt in zip(data_arrays, area_weights)]
+    stats = get_stats(*data_arrays, weights=area_weights)
+    labels = [f'min = {s.min:.02f}; max = {s.max:.02f}; mean = {s.mean:.02f}'
+              for s in stats]
 
     # Create figure
     print('Make plots'); sys.stdout.flush()
     fig = compare_maps(
         wks, xcoords, ycoords, data_arrays,
-        labels=labels,
+        labels=labels, stats=stats,
         mpGeophysicalLineColor='white',
         lbOrientation='horizontal', 
         cnLineLabelsOn=False, cnLinesOn=False, **kwargs
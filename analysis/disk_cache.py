@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+import os, hashlib, numpy
+
+# Root directory for on-disk caches (remap operators, triangulations, etc.);
+# override with the SCREAM_DECADAL_CACHE environment variable
+cache_root = os.environ.get(
+    'SCREAM_DECADAL_CACHE',
+    os.path.join(os.path.expanduser('~'), '.cache', 'scream-decadal')
+)
+
+
+def get_cache_dir(*subdirs):
+    '''
+    Return (and create if needed) a subdirectory of the cache root
+    '''
+    cache_dir = os.path.join(cache_root, *subdirs)
+    os.makedirs(cache_dir, exist_ok=True)
+    return cache_dir
+
+
+def file_key(path):
+    '''
+    Hash a file's absolute path, size and modification time so that cache
+    entries are invalidated whenever the file changes
+    '''
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    return hashlib.sha1(f'{path}:{stat.st_size}:{stat.st_mtime_ns}'.encode()).hexdigest()
+
+
+def array_key(*arrays, **extra):
+    '''
+    Hash the contents of a set of arrays (plus any extra keyword values) to
+    build a content-addressed cache key
+    '''
+    h = hashlib.sha1()
+    for a in arrays:
+        a = numpy.ascontiguousarray(a)
+        h.update(f'{a.dtype.str}{a.shape}'.encode())
+        h.update(a.data)
+    for k in sorted(extra.keys()):
+        h.update(f'{k}={extra[k]!r}'.encode())
+    return h.hexdigest()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+import os, numpy
+from collections import OrderedDict
+from matplotlib.tri import Triangulation
+from scipy.spatial import cKDTree
+from disk_cache import get_cache_dir, array_key
+
+# In-memory LRU of arrays derived from grids (triangles, index arrays, ...)
+# shared by all plotting scripts in a process
+_memory_cache = OrderedDict()
+max_memory_entries = 8
+
+
+def get_cached_array(kind, key, build):
+    '''
+    Return an array derived from a grid, looking first in the in-memory LRU,
+    then on disk under the cache root, and calling build() only if neither
+    has it. key should be a content hash of the inputs (see array_key).
+    '''
+    if (kind, key) in _memory_cache:
+        _memory_cache.move_to_end((kind, key))
+        return _memory_cache[(kind, key)]
+    path = os.path.join(get_cache_dir(kind), f'{key}.npy')
+    if os.path.exists(path):
+        value = numpy.load(path)
+    else:
+        value = build()
+        tmp_path = f'{path}.tmp{os.getpid()}.npy'
+        numpy.save(tmp_path, value)
+        os.replace(tmp_path, path)
+    _memory_cache[(kind, key)] = value
+    while len(_memory_cache) > max_memory_entries:
+        _memory_cache.popitem(last=False)
+    return value
+
+
+def get_triangulation(lon, lat):
+    '''
+    Delaunay triangulation of unstructured grid points, cached by a hash of
+    the coordinate values so each grid is only triangulated once
+    '''
+    lon = numpy.asarray(lon, dtype=numpy.float64)
+    lat = numpy.asarray(lat, dtype=numpy.float64)
+    triangles = get_cached_array(
+        'triangulations', array_key(lon, lat),
+        lambda: Triangulation(lon, lat).triangles.astype(numpy.int32)
+    )
+    return Triangulation(lon, lat, triangles=triangles)
+
+
+def get_regrid_index(lon, lat, nlon, nlat):
+    '''
+    Index of the nearest source column (in lon/lat space, as with
+    scipy.interpolate.griddata(..., method='nearest')) for each pixel of a
+    regular nlat x nlon grid spanning -180..180, -90..90. Apply to data with
+    numpy.take(data, index).
+    '''
+    lon = numpy.asarray(lon, dtype=numpy.float64)
+    lat = numpy.asarray(lat, dtype=numpy.float64)
+    nlon, nlat = int(nlon), int(nlat)
+    def _build():
+        xi = numpy.linspace(-180, 180, nlon)
+        yi = numpy.linspace(-90, 90, nlat)
+        tree = cKDTree(numpy.column_stack([lon, lat]))
+        __, index = tree.query(numpy.column_stack([
+            numpy.broadcast_to(xi[None,:], (nlat, nlon)).ravel(),
+            numpy.broadcast_to(yi[:,None], (nlat, nlon)).ravel(),
+        ]))
+        return index.reshape(nlat, nlon).astype(numpy.int32)
+    return get_cached_array('regrid_indices', array_key(lon, lat, nlon=nlon, nlat=nlat), _build)
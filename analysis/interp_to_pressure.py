@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+import plac, os, numpy, xarray, netCDF4
+from apply_map import interp_along_axis, myprint, update_progress
+
+# Reference pressure used with hybrid coefficients in SCREAM output (Pa)
+p0 = 100000.0
+
+
+def get_pressure(ds):
+    '''
+    Get midpoint pressure (Pa) with dims ('time', 'ncol', 'lev'), either
+    directly from p_mid or from ps and the hybrid coefficients hyam/hybm
+    '''
+    if 'p_mid' in ds:
+        return ds['p_mid'].transpose('time', 'ncol', 'lev')
+    return (ds['hyam'] * p0 + ds['hybm'] * ds['ps']).transpose('time', 'ncol', 'lev')
+
+
+def get_level_name(varname, plev):
+    return f'{varname}_{plev:g}hPa'
+
+
+def interp_dataset(ds, varnames, plevs, log=True):
+    '''
+    Interpolate 3D hybrid-level fields in a (small) dataset onto pressure
+    levels (hPa), returning one ('time', 'ncol') field per variable and level
+    '''
+    pressure = get_pressure(ds).values
+    ds_out = xarray.Dataset()
+    for v in varnames:
+        data = ds[v].transpose('time', 'ncol', 'lev')
+        data_interp = interp_along_axis(
+            numpy.asarray(plevs) * 100.0, pressure, data.values, axis=2,
+            left=numpy.nan, right=numpy.nan, log=log
+        )
+        # Interpolation is done in double precision; write the input precision
+        if numpy.issubdtype(data.dtype, numpy.floating):
+            data_interp = data_interp.astype(data.dtype, copy=False)
+        for k, plev in enumerate(plevs):
+            ds_out[get_level_name(v, plev)] = xarray.DataArray(
+                data_interp[..., k], dims=('time', 'ncol'),
+                coords={'time': ds['time']},
+                attrs={**data.attrs, 'long_name': f'{data.attrs.get("long_name", v)} at {plev:g} hPa'},
+            )
+    return ds_out
+
+
+def append_time_chunk(filename, ds, t0):
+    '''
+    Write the time-dependent variables of ds into an existing file at time
+    indices t0 onward, growing the unlimited time dimension
+    '''
+    with netCDF4.Dataset(filename, 'a') as f:
+        for v in ds.variables:
+            if 'time' in ds[v].dims:
+                f[v][t0:t0 + ds.sizes['time']] = ds[v].values
+
+
+def interp_file(inputfile, outputfile, varnames=None, plevs=(850, 500, 200), time_chunk=1, log=True):
+    '''
+    Interpolate one output file to pressure levels, reading, interpolating
+    and writing time_chunk time indices at a time so memory stays
+    proportional to one chunk
+    '''
+    # Write to a temporary file first so an interrupted run never leaves a
+    # partial file behind (named by process so concurrent runs do not clash)
+    os.makedirs(os.path.dirname(os.path.abspath(outputfile)), exist_ok=True)
+    tmpfile = f'{outputfile}.tmp{os.getpid()}'
+    try:
+        _write_file(inputfile, tmpfile, varnames, plevs, time_chunk, log)
+    except BaseException:
+        if os.path.exists(tmpfile): os.remove(tmpfile)
+        raise
+    os.replace(tmpfile, outputfile)
+    return outputfile
+
+
+def _write_file(inputfile, tmpfile, varnames, plevs, time_chunk, log):
+    with xarray.open_dataset(inputfile, decode_times=False) as ds:
+        if varnames is None:
+            varnames = [v for v in ds.variables.keys() if ds[v].dims == ('time', 'ncol', 'lev') and v != 'p_mid']
+        needed = [v for v in ('p_mid', 'ps', 'hyam', 'hybm') if v in ds]
+        for t0 in range(0, max(ds.sizes['time'], 1), time_chunk):
+            ds_chunk = ds[[*varnames, *needed]].isel(time=slice(t0, t0 + time_chunk)).load()
+            ds_out = interp_dataset(ds_chunk, varnames, plevs, log=log)
+            ds_chunk.close()
+            if t0 > 0:
+                append_time_chunk(tmpfile, ds_out, t0)
+                continue
+
+            # Create the file from the first chunk. Carry over horizontal
+            # coordinates and area so downstream scripts can use the output
+            # just like the original 2D streams; write one time index per
+            # netcdf chunk
+            for v in ('lat', 'lon', 'area'):
+                if v in ds: ds_out[v] = ds[v].load()
+            ds_out.attrs = ds.attrs
+            encoding = {v: {'chunksizes': (1, ds_out.sizes['ncol'])} for v in ds_out.data_vars if ds_out[v].dims == ('time', 'ncol')}
+            ds_out.to_netcdf(tmpfile, encoding=encoding, unlimited_dims=['time'])
+
+
+def get_output_name(inputfile):
+    '''
+    Name of the pressure level file for an output file, tagging the stream
+    name so that stream.plev.YYYY-MM-DD-SSSSS.nc files can be found by the
+    same patterns as any other stream
+    '''
+    root, ext = os.path.splitext(os.path.basename(inputfile))
+    stream, sep, date = root.rpartition('.')
+    if not sep: return f'{root}.plev{ext}'
+    return f'{stream}.plev.{date}{ext}'
+
+
+def main(outputdir, *inputfiles, **kwargs):
+    '''
+    Interpolate 3D fields in a set of output files onto pressure levels,
+    writing one output file per input file to outputdir, named with a .plev
+    stream tag (see get_output_name). Files that are
+    already up to date are skipped so a growing run can be processed
+    incrementally. Options are passed as key=value, e.g. plevs=850,500.
+    '''
+    varnames = kwargs['variables'].split(',') if 'variables' in kwargs.keys() else None
+    plevs = [float(p) for p in str(kwargs.get('plevs', '850,500,200')).split(',')]
+    time_chunk = int(kwargs.get('time_chunk', 1))
+    log = str(kwargs.get('linear', False)) not in ('True', 'true', '1')
+    myprint(f'Interpolate {len(inputfiles)} files to {plevs} hPa')
+    for i, f in enumerate(sorted(inputfiles)):
+        outputfile = os.path.join(outputdir, get_output_name(f))
+        if not (os.path.exists(outputfile) and os.path.getmtime(outputfile) >= os.path.getmtime(f)):
+            interp_file(f, outputfile, varnames=varnames, plevs=plevs, time_chunk=time_chunk, log=log)
+        update_progress(i + 1, len(inputfiles))
+
+
+if __name__ == '__main__':
+    plac.call(main)
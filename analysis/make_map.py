@@ -0,0 +1,425 @@
+#!/usr/bin/env python3
+import plac, os, re, numpy, xarray, multiprocessing
+from scipy.spatial import cKDTree, ConvexHull
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from get_scrip_grid import scrip_grids
+from apply_map import myprint
+
+
+def make_latlon_grid(nlat, nlon):
+    '''
+    Build a SCRIP description of a regular lat/lon grid. Odd nlat gives
+    grid points on the poles (e.g., 721x1440 as in ERA5), even nlat gives
+    cell centers offset half a cell from the poles.
+    '''
+    nlat, nlon = int(nlat), int(nlon)
+    dlat, dlon = 180.0 / (nlat - 1 if nlat % 2 else nlat), 360.0 / nlon
+    lat = numpy.linspace(-90, 90, nlat) if nlat % 2 else -90 + dlat * (numpy.arange(nlat) + 0.5)
+    lon = dlon * numpy.arange(nlon)
+    lat_edges = numpy.clip(numpy.append(lat - dlat / 2, lat[-1] + dlat / 2), -90, 90)
+    lon_edges = numpy.append(lon - dlon / 2, lon[-1] + dlon / 2)
+
+    # Cell centers and corners (counterclockwise from lower left), with
+    # longitude varying fastest as in SCRIP files
+    center_lon, center_lat = numpy.meshgrid(lon, lat)
+    corner_lon = numpy.stack([
+        numpy.meshgrid(lon_edges[:-1], lat)[0], numpy.meshgrid(lon_edges[1:], lat)[0],
+        numpy.meshgrid(lon_edges[1:], lat)[0], numpy.meshgrid(lon_edges[:-1], lat)[0],
+    ], axis=-1)
+    corner_lat = numpy.stack([
+        numpy.meshgrid(lon, lat_edges[:-1])[1], numpy.meshgrid(lon, lat_edges[:-1])[1],
+        numpy.meshgrid(lon, lat_edges[1:])[1], numpy.meshgrid(lon, lat_edges[1:])[1],
+    ], axis=-1)
+    return xarray.Dataset({
+        'grid_center_lat': ('grid_size', center_lat.ravel(), {'units': 'degrees'}),
+        'grid_center_lon': ('grid_size', center_lon.ravel(), {'units': 'degrees'}),
+        'grid_corner_lat': (('grid_size', 'grid_corners'), corner_lat.reshape(-1, 4), {'units': 'degrees'}),
+        'grid_corner_lon': (('grid_size', 'grid_corners'), corner_lon.reshape(-1, 4), {'units': 'degrees'}),
+        'grid_imask': ('grid_size', numpy.ones(nlat * nlon, dtype=numpy.int32)),
+        'grid_dims': ('grid_rank', numpy.array([nlon, nlat], dtype=numpy.int32)),
+    }, attrs={'title': f'{nlat}x{nlon}'})
+
+
+def open_grid(grid):
+    '''
+    Open a grid given as a SCRIP xarray.Dataset, a known grid name (see
+    get_scrip_grid.py), a regular lat/lon size string like '721x1440', or the
+    path to a SCRIP grid file
+    '''
+    if isinstance(grid, xarray.Dataset):
+        return grid
+    elif re.fullmatch(r'\d+x\d+', grid):
+        return make_latlon_grid(*grid.split('x'))
+    elif grid in scrip_grids.keys():
+        return xarray.open_dataset(scrip_grids[grid])
+    else:
+        return xarray.open_dataset(grid)
+
+
+def get_grid_name(grid):
+    if isinstance(grid, xarray.Dataset):
+        return grid.attrs.get('title', 'unknown')
+    return os.path.splitext(os.path.basename(grid))[0].split('_scrip')[0]
+
+
+def get_degrees(ds, name):
+    values = ds[name].values.astype(numpy.float64)
+    if 'rad' in ds[name].attrs.get('units', 'degrees'):
+        values = numpy.degrees(values)
+    return values
+
+
+def lonlat_to_xyz(lon, lat):
+    '''
+    Convert longitude and latitude in degrees to points on the unit sphere
+    '''
+    lon, lat = numpy.radians(lon), numpy.radians(lat)
+    return numpy.stack([
+        numpy.cos(lat) * numpy.cos(lon), numpy.cos(lat) * numpy.sin(lon), numpy.sin(lat)
+    ], axis=-1)
+
+
+def is_latlon_grid(ds):
+    '''
+    Check whether a SCRIP grid is a logically rectangular lat/lon grid
+    '''
+    if ds.sizes.get('grid_rank', 1) != 2:
+        return False
+    nlon, nlat = ds['grid_dims'].values
+    lat = get_degrees(ds, 'grid_center_lat').reshape(nlat, nlon)
+    lon = get_degrees(ds, 'grid_center_lon').reshape(nlat, nlon)
+    return bool(numpy.all(lat == lat[:, :1]) and numpy.all(lon == lon[:1, :]))
+
+
+def map_chunks(func, n, chunk_size, workers):
+    '''
+    Apply func(i0, i1) over chunks of destination points in a thread pool and
+    concatenate the (S, row, col) results; the KD-tree and linear algebra
+    kernels used here release the GIL
+    '''
+    chunks = [(i0, min(i0 + chunk_size, n)) for i0 in range(0, n, chunk_size)]
+    with ThreadPoolExecutor(workers) as executor:
+        results = list(executor.map(lambda c: func(*c), chunks))
+    return tuple(numpy.concatenate(r) for r in zip(*results))
+
+
+def nearest_weights(src_grid, dst_grid, workers=None, chunk_size=2**18):
+    '''
+    Nearest-neighbour weights: each destination point takes the value of the
+    closest source point (chordal distance on the unit sphere)
+    '''
+    src_xyz = lonlat_to_xyz(get_degrees(src_grid, 'grid_center_lon'), get_degrees(src_grid, 'grid_center_lat'))
+    dst_xyz = lonlat_to_xyz(get_degrees(dst_grid, 'grid_center_lon'), get_degrees(dst_grid, 'grid_center_lat'))
+    tree = cKDTree(src_xyz)
+    def _chunk(i0, i1):
+        __, col = tree.query(dst_xyz[i0:i1])
+        return numpy.ones(i1 - i0), numpy.arange(i0, i1), col
+    return map_chunks(_chunk, len(dst_xyz), chunk_size, workers)
+
+
+def bilinear_weights(src_grid, dst_grid, workers=None, chunk_size=2**18):
+    '''
+    Bilinear weights. For a regular lat/lon source grid this is standard
+    bilinear interpolation in lon/lat (periodic in longitude). For an
+    unstructured source grid (e.g., ne1024pg2) it is linear interpolation on
+    a spherical Delaunay triangulation of the source points.
+    '''
+    if is_latlon_grid(src_grid):
+        return _latlon_bilinear_weights(src_grid, dst_grid, workers, chunk_size)
+    else:
+        return _triangle_linear_weights(src_grid, dst_grid, workers, chunk_size)
+
+
+def _latlon_bilinear_weights(src_grid, dst_grid, workers, chunk_size):
+    nlon, nlat = src_grid['grid_dims'].values
+    lat = get_degrees(src_grid, 'grid_center_lat').reshape(nlat, nlon)[:, 0]
+    lon = get_degrees(src_grid, 'grid_center_lon').reshape(nlat, nlon)[0, :] % 360
+    lat_order, lon_order = numpy.argsort(lat), numpy.argsort(lon)
+    lat, lon = lat[lat_order], lon[lon_order]
+    lon_ext = numpy.append(lon, lon[0] + 360)
+    dst_lat = get_degrees(dst_grid, 'grid_center_lat')
+    dst_lon = get_degrees(dst_grid, 'grid_center_lon') % 360
+    def _chunk(i0, i1):
+        # Bracketing longitude indices (periodic) and latitude indices
+        # (clamped to the outermost source latitudes)
+        x = numpy.where(dst_lon[i0:i1] < lon[0], dst_lon[i0:i1] + 360, dst_lon[i0:i1])
+        i = numpy.clip(numpy.searchsorted(lon_ext, x, side='right') - 1, 0, nlon - 1)
+        fx = (x - lon_ext[i]) / (lon_ext[i + 1] - lon_ext[i])
+        y = numpy.clip(dst_lat[i0:i1], lat[0], lat[-1])
+        j = numpy.clip(numpy.searchsorted(lat, y, side='right') - 1, 0, nlat - 2)
+        fy = numpy.clip((y - lat[j]) / (lat[j + 1] - lat[j]), 0, 1)
+        ii = numpy.stack([i, (i + 1) % nlon, (i + 1) % nlon, i], axis=-1)
+        jj = numpy.stack([j, j, j + 1, j + 1], axis=-1)
+        S = numpy.stack([(1 - fx) * (1 - fy), fx * (1 - fy), fx * fy, (1 - fx) * fy], axis=-1)
+        col = lat_order[jj] * nlon + lon_order[ii]
+        row = numpy.repeat(numpy.arange(i0, i1), 4)
+        return S.ravel(), row, col.ravel()
+    S, row, col = map_chunks(_chunk, len(dst_lat), chunk_size, workers)
+    keep = S > 0
+    return S[keep], row[keep], col[keep]
+
+
+def _triangle_linear_weights(src_grid, dst_grid, workers, chunk_size, ncandidates=8, max_candidates=512):
+    src_xyz = lonlat_to_xyz(get_degrees(src_grid, 'grid_center_lon'), get_degrees(src_grid, 'grid_center_lat'))
+    dst_xyz = lonlat_to_xyz(get_degrees(dst_grid, 'grid_center_lon'), get_degrees(dst_grid, 'grid_center_lat'))
+
+    # The convex hull of points on the sphere is their spherical Delaunay
+    # triangulation; candidate triangles for each destination point are the
+    # ones with the nearest centroids
+    myprint('Triangulate source grid')
+    triangles = ConvexHull(src_xyz).simplices
+    vertices = src_xyz[triangles]
+    inverse = numpy.linalg.inv(numpy.transpose(vertices, (0, 2, 1)))
+    centroid_tree = cKDTree(vertices.mean(axis=1))
+    point_tree = cKDTree(src_xyz)
+    nfallback = []
+
+    def _find_triangles(p, k):
+        __, candidates = centroid_tree.query(p, k=min(k, len(triangles)))
+        candidates = candidates.reshape(len(p), -1)
+
+        # Barycentric coordinates of the point's central projection onto each
+        # candidate triangle; the point is inside if all are non-negative
+        # (and the triangle faces the point rather than its antipode)
+        w = numpy.einsum('nkij,nj->nki', inverse[candidates], p)
+        total = w.sum(axis=-1, keepdims=True)
+        w = w / total
+        inside = numpy.all(w >= -1e-10, axis=-1) & (total[..., 0] > 0)
+        found = inside.any(axis=-1)
+        first = numpy.argmax(inside, axis=-1)
+        n = numpy.arange(len(p))
+        S = numpy.clip(w[n, first], 0, None)
+        S = S / S.sum(axis=-1, keepdims=True)
+        return S, triangles[candidates[n, first]], found
+
+    def _chunk(i0, i1):
+        p = dst_xyz[i0:i1]
+        S, col, found = _find_triangles(p, ncandidates)
+
+        # On irregular grids the containing triangle is not always among the
+        # nearest few centroids, so search more of them for the points left
+        k = ncandidates
+        while not found.all() and k < min(max_candidates, len(triangles)):
+            k *= 8
+            missing = numpy.flatnonzero(~found)
+            S[missing], col[missing], found[missing] = _find_triangles(p[missing], k)
+
+        # Fall back to nearest neighbour if no containing triangle was found
+        if not found.all():
+            __, nearest = point_tree.query(p[~found])
+            S[~found] = [1, 0, 0]
+            col[~found] = nearest[:, None]
+            nfallback.append(int((~found).sum()))
+        row = numpy.repeat(numpy.arange(i0, i1), 3)
+        return S.ravel(), row, col.ravel()
+    S, row, col = map_chunks(_chunk, len(dst_xyz), chunk_size, workers)
+    if nfallback:
+        myprint(f'Warning: no containing triangle found for {sum(nfallback)} of {len(dst_xyz)} points; using nearest neighbour weights for them')
+    keep = S > 0
+    return S[keep], row[keep], col[keep]
+
+
+def get_corners_xyz(grid):
+    '''
+    Cell corners on the unit sphere, shape (grid_size, grid_corners, 3)
+    '''
+    return lonlat_to_xyz(get_degrees(grid, 'grid_corner_lon'), get_degrees(grid, 'grid_corner_lat'))
+
+
+def polygon_area(vertices):
+    '''
+    Area of convex spherical polygons with great circle edges, given vertices
+    on the unit sphere with shape (..., nvertices, 3). Computed as a fan of
+    spherical triangles from the first vertex (Van Oosterom and Strackee);
+    repeated vertices contribute zero area.
+    '''
+    a = vertices[..., :1, :]
+    b, c = vertices[..., 1:-1, :], vertices[..., 2:, :]
+    numer = numpy.abs(numpy.einsum('...i,...i->...', a, numpy.cross(b, c)))
+    denom = 1 + numpy.einsum('...i,...i->...', a, b) + numpy.einsum('...i,...i->...', b, c) + numpy.einsum('...i,...i->...', c, a)
+    return numpy.sum(2 * numpy.arctan2(numer, denom), axis=-1)
+
+
+def clip_polygons(subject, clip):
+    '''
+    Batched Sutherland-Hodgman clipping of planar polygons. subject has shape
+    (npairs, nsubject, 2) and clip has shape (npairs, nclip, 2); clip polygons
+    must be convex but may have either orientation. Returns the clipped
+    vertices (padded by repeating the first vertex) and the vertex counts.
+    '''
+    npairs, nclip = clip.shape[:2]
+    nmax = subject.shape[1] + nclip
+    pairs = numpy.arange(npairs)[:, None]
+
+    # Orientation of each clip polygon (shoelace formula)
+    x, y = clip[..., 0], clip[..., 1]
+    orient = numpy.sign(numpy.sum(x * numpy.roll(y, -1, axis=1) - numpy.roll(x, -1, axis=1) * y, axis=1))[:, None]
+
+    vertices, count = subject, numpy.full(npairs, subject.shape[1])
+    for k in range(nclip):
+        a, b = clip[:, k, None, :], clip[:, (k + 1) % nclip, None, :]
+        d = b - a
+        nv = vertices.shape[1]
+        prev = vertices[pairs, (numpy.arange(nv)[None, :] - 1) % numpy.maximum(count, 1)[:, None]]
+        side_cur = orient * (d[..., 0] * (vertices[..., 1] - a[..., 1]) - d[..., 1] * (vertices[..., 0] - a[..., 0]))
+        side_prev = orient * (d[..., 0] * (prev[..., 1] - a[..., 1]) - d[..., 1] * (prev[..., 0] - a[..., 0]))
+        active = numpy.arange(nv)[None, :] < count[:, None]
+        cur_in, prev_in = side_cur >= 0, side_prev >= 0
+
+        # Each input vertex emits an intersection point if the edge from the
+        # previous vertex crosses the clip line, then itself if inside
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            t = numpy.where(cur_in != prev_in, side_prev / (side_prev - side_cur), 0)
+        crossing = prev + t[..., None] * (vertices - prev)
+        out = numpy.stack([crossing, vertices], axis=2).reshape(npairs, 2 * nv, 2)
+        keep = numpy.stack([active & (cur_in != prev_in), active & cur_in], axis=2).reshape(npairs, 2 * nv)
+
+        # Compact kept vertices to the front and pad with the first vertex
+        order = numpy.argsort(~keep, axis=1, kind='stable')[:, :nmax]
+        vertices = out[pairs, order]
+        count = numpy.minimum(keep.sum(axis=1), nmax)
+        pad = numpy.arange(vertices.shape[1])[None, :] >= count[:, None]
+        vertices = numpy.where(pad[..., None], vertices[:, :1, :], vertices)
+    return vertices, count
+
+
+# Grid state shared with forked worker processes for conservative weights
+_conservative_state = {}
+
+
+def _conservative_chunk(i0, i1):
+    state = _conservative_state
+    src_corners, dst_corners = state['src_corners'], state['dst_corners']
+
+    # Candidate overlaps: destination cells whose centers are within the sum
+    # of the two cells' circumscribing radii
+    candidates = state['dst_tree'].query_ball_point(
+        state['src_centers'][i0:i1], state['src_radii'][i0:i1] + state['dst_radius_max']
+    )
+    ncandidates = numpy.array([len(c) for c in candidates])
+    src = numpy.repeat(numpy.arange(i0, i1), ncandidates)
+    dst = numpy.concatenate([numpy.asarray(c, dtype=numpy.int64) for c in candidates]) if len(src) else numpy.zeros(0, dtype=numpy.int64)
+    if len(src) == 0:
+        return numpy.zeros(0), dst, src
+
+    # Gnomonic projection onto the plane tangent at the source cell center;
+    # great circle edges map to straight lines, so planar clipping is exact
+    center = state['src_centers'][src]
+    e1 = numpy.cross([0., 0., 1.], center)
+    e1[numpy.linalg.norm(e1, axis=-1) < 1e-12] = [1., 0., 0.]
+    e1 /= numpy.linalg.norm(e1, axis=-1, keepdims=True)
+    e2 = numpy.cross(center, e1)
+    def _project(xyz):
+        z = numpy.einsum('nki,ni->nk', xyz, center)
+        return numpy.stack([numpy.einsum('nki,ni->nk', xyz, e1) / z, numpy.einsum('nki,ni->nk', xyz, e2) / z], axis=-1)
+    vertices, count = clip_polygons(_project(src_corners[src]), _project(dst_corners[dst]))
+
+    # Map clipped vertices back to the sphere and compute overlap areas
+    xyz = center[:, None, :] + vertices[..., :1] * e1[:, None, :] + vertices[..., 1:] * e2[:, None, :]
+    xyz /= numpy.linalg.norm(xyz, axis=-1, keepdims=True)
+    overlap = numpy.where(count >= 3, polygon_area(xyz), 0) / state['dst_area'][dst]
+
+    # Drop slivers from roundoff along shared edges
+    keep = overlap > 1e-12
+    return overlap[keep], dst[keep], src[keep]
+
+
+def conservative_weights(src_grid, dst_grid, workers=None, chunk_size=2**14):
+    '''
+    First-order conservative weights from the overlap areas of source and
+    destination cells (S = overlap area / destination cell area). Cell edges
+    are treated as great circle arcs. Candidate overlaps come from a KD-tree
+    of destination cell centers, and source cells are processed in chunks on
+    a pool of forked worker processes.
+    '''
+    myprint('Compute cell corners and areas')
+    src_corners, dst_corners = get_corners_xyz(src_grid), get_corners_xyz(dst_grid)
+    src_centers = src_corners.mean(axis=1)
+    src_centers /= numpy.linalg.norm(src_centers, axis=-1, keepdims=True)
+    dst_centers = dst_corners.mean(axis=1)
+    dst_centers /= numpy.linalg.norm(dst_centers, axis=-1, keepdims=True)
+    dst_radii = numpy.linalg.norm(dst_corners - dst_centers[:, None, :], axis=-1).max(axis=-1)
+    _conservative_state.update(
+        src_corners=src_corners, dst_corners=dst_corners, src_centers=src_centers,
+        src_radii=numpy.linalg.norm(src_corners - src_centers[:, None, :], axis=-1).max(axis=-1),
+        dst_radius_max=dst_radii.max(), dst_area=polygon_area(dst_corners),
+        dst_tree=cKDTree(dst_centers),
+    )
+
+    # Workers inherit the grid state through fork rather than pickling it
+    myprint('Compute overlaps')
+    n = len(src_corners)
+    chunks = [(i0, min(i0 + chunk_size, n)) for i0 in range(0, n, chunk_size)]
+    try:
+        if workers == 1:
+            results = [_conservative_chunk(*c) for c in chunks]
+        else:
+            with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('fork')) as executor:
+                results = list(executor.map(_conservative_chunk, *zip(*chunks)))
+    finally:
+        _conservative_state.clear()
+    return tuple(numpy.concatenate(r) for r in zip(*results))
+
+
+def write_map_file(mapfile, S, row, col, src_grid, dst_grid):
+    '''
+    Write weights to a mapping file in the S/row/col (1-based) format read by
+    apply_map, along with source and destination grid information
+    '''
+    ds_map = xarray.Dataset({
+        'S': ('n_s', S.astype(numpy.float64)),
+        'row': ('n_s', (row + 1).astype(numpy.int32)),
+        'col': ('n_s', (col + 1).astype(numpy.int32)),
+        'xc_a': ('n_a', get_degrees(src_grid, 'grid_center_lon')),
+        'yc_a': ('n_a', get_degrees(src_grid, 'grid_center_lat')),
+        'xc_b': ('n_b', get_degrees(dst_grid, 'grid_center_lon')),
+        'yc_b': ('n_b', get_degrees(dst_grid, 'grid_center_lat')),
+        'src_grid_dims': ('src_grid_rank', src_grid['grid_dims'].values.astype(numpy.int32)),
+        'dst_grid_dims': ('dst_grid_rank', dst_grid['grid_dims'].values.astype(numpy.int32)),
+    })
+    for name, grid, dim in (('area_a', src_grid, 'n_a'), ('area_b', dst_grid, 'n_b')):
+        if 'grid_area' in grid:
+            ds_map[name] = (dim, grid['grid_area'].values)
+    os.makedirs(os.path.dirname(os.path.abspath(mapfile)), exist_ok=True)
+    ds_map.to_netcdf(mapfile)
+    return mapfile
+
+
+weight_generators = {
+    'nearest': nearest_weights,
+    'bilinear': bilinear_weights,
+    'fv2fv': conservative_weights,
+}
+
+
+def make_map(src_grid, dst_grid, mapfile, method='bilinear', workers=None):
+    '''
+    Generate remap weights between two grids and write them to mapfile
+    '''
+    if method not in weight_generators.keys():
+        raise ValueError(f'method {method} not known; please choose one of {", ".join(weight_generators.keys())}')
+    src_ds, dst_ds = open_grid(src_grid), open_grid(dst_grid)
+    myprint(f'Compute {method} weights from {get_grid_name(src_grid)} to {get_grid_name(dst_grid)}')
+    S, row, col = weight_generators[method](src_ds, dst_ds, workers=workers)
+    myprint(f'Write {len(S)} weights to {mapfile}')
+    return write_map_file(mapfile, S, row, col, src_ds, dst_ds)
+
+
+def get_map_file(src_grid, dst_grid, mapping_root, method='bilinear', workers=None):
+    '''
+    Return the path to a map file in mapping_root, generating it first if it
+    does not exist yet
+    '''
+    mapfile = f'{mapping_root}/map_{get_grid_name(src_grid)}_to_{get_grid_name(dst_grid)}_{method}.nc'
+    if not os.path.exists(mapfile):
+        make_map(src_grid, dst_grid, mapfile, method=method, workers=workers)
+    return mapfile
+
+
+def main(src_grid, dst_grid, mapfile, method='bilinear', workers=None):
+    make_map(src_grid, dst_grid, mapfile, method=method,
+             workers=None if workers is None else int(workers))
+
+
+if __name__ == '__main__':
+    plac.call(main)
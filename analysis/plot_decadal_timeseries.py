@@ -1,30 +1,42 @@
 #!/usr/bin/env python3
 
-import xarray
-from glob import glob
-import sys, os
+import plac
+import sys
 from matplotlib import pyplot
-from plot_timeseries import main as plot_timeseries
+from plot_timeseries import plot_global_mean
+from run_catalog import Catalog
+from reduction_store import get_reductions
 from e3smplot.e3sm_utils import get_data
 from cartopy import crs
 
 rundir = '/lustre/orion/cli115/proj-shared/brhillman/e3sm_scratch/decadal-production-20240305.ne1024pg2_ne1024pg2.F20TR-SCREAMv1.run1/run'
 
-# Find output streams
-output_streams = [os.path.basename(f).replace('.1994-10-01-00000.nc', '') for f in glob(f'{rundir}/*.1994-10-01-00000.nc')]
-#output_stream = 'output.scream.decadal.1dailyMAX_ne1024pg2.MAX.ndays_x1' #'output.scream.decadal.monthlyAVG_ne30pg2.AVERAGE.nmonths_x1'
-for output_stream in output_streams:
-    print(f'{output_stream}...'); sys.stdout.flush()
 
-    # Find files
-    files = sorted(glob(f'{rundir}/{output_stream}.????-??-??-?????.nc'))
+@plac.opt('workers', 'number of worker processes for reading files', type=int)
+def main(workers=1):
+    # Find output streams from the run directory catalog; only files that are
+    # new or have changed since the last refresh are opened
+    catalog = Catalog(rundir)
+    catalog.refresh(workers=workers)
+    output_streams = catalog.streams()
+    #output_stream = 'output.scream.decadal.1dailyMAX_ne1024pg2.MAX.ndays_x1' #'output.scream.decadal.monthlyAVG_ne30pg2.AVERAGE.nmonths_x1'
+    for output_stream in output_streams:
+        print(f'{output_stream}...'); sys.stdout.flush()
 
-    # Get list of fields to plot; we will plot all the 2D fields
-    with xarray.open_mfdataset(files, data_vars='minimal', coords='minimal', compat='override') as ds:
-        fields = [v for v in ds.variables.keys() if ds[v].dims == ('time', 'ncol')]
+        # Find files
+        files = catalog.files(output_stream)
+        if not files: continue
 
-    # Plot all those fields
-    for v in fields:
-        print(f'  {v}'); sys.stdout.flush()
-        figname = f'figures/timeseries/{v}.timeseries.{output_stream}.png'
-        plot_timeseries(v, figname, *files)
+        # Global mean, min and max of all the 2D fields; only files that are new
+        # or have changed since the last run are read
+        reductions = get_reductions(files, workers=workers)
+
+        # Plot all those fields
+        for v in reductions.data_vars:
+            print(f'  {v}'); sys.stdout.flush()
+            figname = f'figures/timeseries/{v}.timeseries.{output_stream}.png'
+            plot_global_mean(reductions[v].sel(statistic='mean'), figname)
+
+
+if __name__ == '__main__':
+    plac.call(main)
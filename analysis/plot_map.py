@@ -1,14 +1,15 @@
 #!/usr/bin/env python3
 import plac, numpy
 from matplotlib import pyplot
-from matplotlib.tri import Triangulation
+from grid_cache import get_triangulation, get_regrid_index
+from raster_map import plot_raster
 from mpl_toolkits.axes_grid1 import make_axes_locatable
 from cartopy import crs
 from cartopy.util import add_cyclic_point
 import xarray
 from time import perf_counter
-from scipy.interpolate import griddata
-from e3smplot.e3sm_utils import get_data, get_area_weights, area_average
+from e3smplot.e3sm_utils import get_data, get_area_weights
+from stream_stats import get_stats
 
 
 def fix_longitudes(lon):
@@ -17,7 +18,7 @@ def fix_longitudes(lon):
     #return lon #lon.assign_coords(lon=((lon + 180) % 360) - 180) #numpy.where(lon > 180, lon - 360, lon))
 
 
-def plot_map(lon, lat, data, axes=None, plot_method='triangulation', nlon=360, nlat=180, title=None, **kwargs):
+def plot_map(lon, lat, data, axes=None, plot_method='triangulation', nlon=360, nlat=180, title=None, draw_colorbar=True, **kwargs):
 
     # Get current axes
     if axes is None:
@@ -33,7 +34,7 @@ def plot_map(lon, lat, data, axes=None, plot_method='triangulation', nlon=360, n
     if len(data.shape) == 1:
         if plot_method == 'triangulation':
             # Calculate triangulation
-            triangulation = Triangulation(lon.values, lat.values)
+            triangulation = get_triangulation(lon.values, lat.values)
 
             # Plot using triangulation
             pl = axes.tripcolor(
@@ -43,8 +44,12 @@ def plot_map(lon, lat, data, axes=None, plot_method='triangulation', nlon=360, n
         elif plot_method == 'regrid':
             xi = numpy.linspace(-180, 180, int(nlon))
             yi = numpy.linspace(-90, 90, int(nlat))
-            data_regridded = griddata((lon, lat), data, (xi[None,:], yi[:,None]), method='nearest')
+            data_regridded = numpy.take(numpy.asarray(data), get_regrid_index(lon.values, lat.values, nlon, nlat))
             pl = axes.pcolormesh(xi, yi, data_regridded, transform=crs.PlateCarree(), **kwargs)
+        elif plot_method == 'raster':
+            # Aggregate columns directly into output pixels
+            axes.set_global()
+            pl = plot_raster(axes, lon.values, lat.values, data, **kwargs)
         else:
             raise ValueError('method %s not known'%method)
     #elif ('lon' in data.dims) and ('lat' in data.dims):
@@ -72,19 +77,37 @@ def plot_map(lon, lat, data, axes=None, plot_method='triangulation', nlon=360, n
     # Add a colorbar
     #pos = axes.get_position()
     #cax = pyplot.gcf().add_axes([pos.x0, pos.y0 - (0.075 * pos.height), pos.width, 0.05 * pos.height])
-    divider = make_axes_locatable(axes)
-    cax = divider.append_axes("bottom", size="5%", pad=0.1, axes_class=pyplot.Axes)
-    cb = pyplot.colorbar(
-        pl, cax=cax, orientation='horizontal',
-        label='%s (%s)'%(data.long_name, data.units),
-        #pad=0.02
-        #shrink=0.8, pad=0.02
-    )
+    if draw_colorbar:
+        divider = make_axes_locatable(axes)
+        cax = divider.append_axes("bottom", size="5%", pad=0.1, axes_class=pyplot.Axes)
+        cb = pyplot.colorbar(
+            pl, cax=cax, orientation='horizontal',
+            label='%s (%s)'%(data.long_name, data.units),
+            #pad=0.02
+            #shrink=0.8, pad=0.02
+        )
+    else:
+        cb = None
 
     # Return plot and colorbar
     return pl, cb
 
 
+def plot_mean_map(data, lon, lat, weights, outputfile, **kwargs):
+
+    # Compute area average, min and max in one pass
+    stats, = get_stats(data, weights=weights)
+    plot_title = f'mean = {stats.mean:.2f}; min = {stats.min:.2f}; max = {stats.max:.2f}'
+
+    # Make figure
+    figure, axes = pyplot.subplots(1, 1, subplot_kw=dict(projection=crs.PlateCarree()))
+    pl, cb = plot_map(lon, lat, data, title=plot_title, **kwargs)
+    figure.savefig(outputfile, bbox_inches='tight')
+
+    # Clean up
+    pyplot.close(figure)
+
+
 def main(varname, outputfile, *inputfiles, **kwargs):
 
     print(f'Plot {varname} to {outputfile}...')
@@ -100,18 +123,10 @@ def main(varname, outputfile, *inputfiles, **kwargs):
     # Reduce data; TODO: apply vertical reduction?
     data = data.mean(dim='time', keep_attrs=True)
 
-    # Compute area average
-    weights = get_area_weights(ds)
-    data_mean = area_average(data, weights)
-    plot_title = f'mean = {data_mean.values:.2f}; min = {data.min().values:.2f}; max = {data.max().values:.2f}'
-
     # Make figure
-    figure, axes = pyplot.subplots(1, 1, subplot_kw=dict(projection=crs.PlateCarree()))
-    pl, cb = plot_map(lon, lat, data, title=plot_title, **kwargs)
-    figure.savefig(outputfile, bbox_inches='tight')
+    plot_mean_map(data, lon, lat, get_area_weights(ds), outputfile, **kwargs)
 
     # Clean up
-    pyplot.close(figure)
     ds.close()
 
 
@@ -6,7 +6,8 @@ import numpy
 import xarray
 import os
 from e3smplot.utils import nice_cntr_levels
-from e3smplot.e3sm_utils import get_data, get_area_weights, area_average
+from e3smplot.e3sm_utils import get_data, get_area_weights
+from stream_stats import get_stats
 import dask
 
 def plot_map(wks, x, y, data, **kwargs):
@@ -118,16 +119,15 @@ def main(varname, plotname, *datafiles, gridfile=None,
         mx = (x > float(kwargs['mpMinLonF'])) & (x < float(kwargs['mpMaxLonF']))
         my = (y > float(kwargs['mpMinLatF'])) & (y < float(kwargs['mpMaxLatF']))
         dsub = data.where(mx).where(my)
-        print(f'data.min = {dsub.min().values}; data.max = {dsub.max().values}')
-        kwargs['tiMainString'] = f'min = {dsub.min().values:.02f}; max = {dsub.max().values:.02f}'
+        stats, = get_stats(dsub)
+        print(f'data.min = {stats.min}; data.max = {stats.max}')
+        kwargs['tiMainString'] = f'min = {stats.min:.02f}; max = {stats.max:.02f}'
 
     # Get title string
     if 'tiMainString' not in kwargs.keys():
-        dmin = data.min().values
-        dmax = data.max().values
         wgts = get_area_weights(ds_data)
-        davg = area_average(data, wgts)
-        kwargs['tiMainString'] = f'min = {dmin:.2f}; max = {dmax:.2f}; mean = {davg.values:.2f}'
+        stats, = get_stats(data, weights=wgts)
+        kwargs['tiMainString'] = f'min = {stats.min:.2f}; max = {stats.max:.2f}; mean = {stats.mean:.2f}'
         kwargs['tiMainFontHeightF'] = 0.02
 
     # Make plot
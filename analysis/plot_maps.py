@@ -1,11 +1,11 @@
 #!/usr/bin/env python3
 import plac, numpy, xarray
 from matplotlib import pyplot
-from matplotlib.tri import Triangulation
+from grid_cache import get_triangulation, get_regrid_index
+from raster_map import plot_raster
 from cartopy import crs
 from cartopy.util import add_cyclic_point
 from time import perf_counter
-from scipy.interpolate import griddata
 from e3smplot.e3sm_utils import infer_grid_file, infer_grid_coords, get_data
 
 
@@ -44,7 +44,7 @@ def plot_map(lon, lat, data, axes=None,
     if 'ncol' in data.dims:
         if plot_method == 'triangulation':
             # Calculate triangulation
-            triangulation = Triangulation(lon.values, lat.values)
+            triangulation = get_triangulation(lon.values, lat.values)
 
             # Plot using triangulation
             pl = axes.tripcolor(
@@ -54,10 +54,13 @@ def plot_map(lon, lat, data, axes=None,
         elif plot_method == 'regrid':
             xi = numpy.linspace(-180, 180, int(nlon))
             yi = numpy.linspace(-90, 90, int(nlat))
-            data_regridded = griddata((lon, lat), data, (xi[None,:], yi[:,None]), method='nearest')
+            data_regridded = numpy.take(numpy.asarray(data), get_regrid_index(lon.values, lat.values, nlon, nlat))
             pl = axes.pcolormesh(xi, yi, data_regridded, **kwargs)
+        elif plot_method == 'raster':
+            # Aggregate columns directly into output pixels
+            pl = plot_raster(axes, lon.values, lat.values, data, **kwargs)
         else:
-            raise ValueError('method %s not known; please choose one of triangulation or regrid'%method)
+            raise ValueError('method %s not known; please choose one of triangulation, regrid or raster'%method)
     elif ('lon' in data.dims) and ('lat' in data.dims):
         # need to add a cyclic point
         #_data, _lon = add_cyclic_point(data.transpose('lat', 'lon').values, coord=lon.values)
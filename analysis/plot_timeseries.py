@@ -3,6 +3,7 @@
 import xarray, os
 from e3smplot.e3sm_utils import get_data, area_average
 from matplotlib import pyplot
+from reduction_store import get_reductions
 
 
 def plot_timeseries(data, **kwargs):
@@ -23,17 +24,7 @@ def plot_timeseries(data, **kwargs):
     return pl
 
 
-def main(vname, figname, *inputfiles, **kwargs):
-    # Open dataset
-    ds = xarray.open_mfdataset(inputfiles)
-
-    # Select data
-    d = get_data(ds, vname)
-    a = get_data(ds, 'area')
-
-    # Compute area-weighted global mean
-    dmean = area_average(d, a, dims=('ncol',))
-
+def plot_global_mean(dmean, figname, **kwargs):
     # Make figure
     fig, ax = pyplot.subplots(1, 1)
     pl = plot_timeseries(dmean, **kwargs)
@@ -44,6 +35,22 @@ def main(vname, figname, *inputfiles, **kwargs):
 
     # Clean up
     pyplot.close(fig)
+
+
+def main(vname, figname, *inputfiles, **kwargs):
+    # Area-weighted global means of (time, ncol) fields come from the
+    # per-file reduction store, so only new or changed files are read
+    reductions = get_reductions(inputfiles)
+    if vname in reductions:
+        plot_global_mean(reductions[vname].sel(statistic='mean'), figname, **kwargs)
+        return
+
+    # Otherwise open dataset and compute area-weighted global mean
+    ds = xarray.open_mfdataset(inputfiles)
+    d = get_data(ds, vname)
+    a = get_data(ds, 'area')
+    dmean = area_average(d, a, dims=('ncol',))
+    plot_global_mean(dmean, figname, **kwargs)
     ds.close()
 
 
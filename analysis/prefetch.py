@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+import threading, queue
+from time import perf_counter
+
+
+class Prefetcher(object):
+    '''
+    Iterate over (key, load(key)) for a sequence of keys, loading up to depth
+    items ahead in a background thread so that reading the next item overlaps
+    with whatever the consumer does with the current one. With depth=0 items
+    are loaded in the consumer's thread.
+
+    Timing counters: load_time is the total time spent loading, and
+    wait_time is the time the consumer spent blocked waiting for items, so
+    load_time - wait_time is the I/O that was hidden behind the consumer.
+    '''
+    _done = object()
+
+    def __init__(self, load, keys, depth=2):
+        self.load = load
+        self.keys = list(keys)
+        self.depth = int(depth)
+        self.load_time = 0.0
+        self.wait_time = 0.0
+        self.count = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _timed_load(self, key):
+        t0 = perf_counter()
+        value = self.load(key)
+        self.load_time += perf_counter() - t0
+        return value
+
+    def _put(self, q, item):
+        # Block while the queue is full, but give up if the consumer stopped
+        while not self._stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _produce(self, q):
+        try:
+            for key in self.keys:
+                if not self._put(q, (key, self._timed_load(key))): return
+        except BaseException as e:
+            self._put(q, e)
+            return
+        self._put(q, self._done)
+
+    def __iter__(self):
+        if self.depth <= 0:
+            for key in self.keys:
+                t0 = perf_counter()
+                value = self._timed_load(key)
+                self.wait_time += perf_counter() - t0
+                self.count += 1
+                yield key, value
+            return
+        q = queue.Queue(maxsize=self.depth)
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._produce, args=(q,), daemon=True)
+        self._thread.start()
+        try:
+            while True:
+                t0 = perf_counter()
+                item = q.get()
+                self.wait_time += perf_counter() - t0
+                if item is self._done: return
+                if isinstance(item, BaseException): raise item
+                self.count += 1
+                yield item
+        finally:
+            self.close()
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    @property
+    def hidden_time(self):
+        return max(self.load_time - self.wait_time, 0.0)
+
+    def summary(self):
+        hidden = 100 * self.hidden_time / self.load_time if self.load_time > 0 else 0
+        return (f'Read {self.count} items in {self.load_time:.2f} s; waited {self.wait_time:.2f} s '
+                f'({hidden:.0f}% of read time hidden, prefetch depth {self.depth})')
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+import numpy
+from cartopy import crs
+from scipy.spatial import cKDTree
+from disk_cache import array_key
+from grid_cache import get_cached_array
+from make_map import lonlat_to_xyz
+
+
+def get_raster_index(lon, lat, projection, extent, shape, cache=True):
+    '''
+    For unstructured points, compute the flat index of the output pixel each
+    point falls in (-1 if not visible in this projection), and for each pixel
+    that receives no points, the nearest visible point to use instead (-1 if
+    the pixel is off the globe). Returned concatenated as one int32 array of
+    length npoints + npixels; cached by grid, projection, extent and image
+    shape unless cache=False (e.g. for a projection that changes every frame).
+    '''
+    lon = numpy.asarray(lon, dtype=numpy.float64)
+    lat = numpy.asarray(lat, dtype=numpy.float64)
+    ny, nx = shape
+    x0, x1, y0, y1 = extent
+    def _build():
+        # Pixel containing each source point in projected coordinates
+        xy = projection.transform_points(crs.PlateCarree(), lon, lat)
+        ix = numpy.floor((xy[:, 0] - x0) / (x1 - x0) * nx)
+        iy = numpy.floor((xy[:, 1] - y0) / (y1 - y0) * ny)
+        visible = numpy.isfinite(ix) & numpy.isfinite(iy) & (ix >= 0) & (ix < nx) & (iy >= 0) & (iy < ny)
+        pixel = numpy.where(visible, iy * nx + ix, -1).astype(numpy.int32)
+
+        # Nearest source point (on the unit sphere) for pixels with no points
+        fill = numpy.full(nx * ny, -1, dtype=numpy.int32)
+        empty = numpy.bincount(pixel[visible], minlength=nx * ny) == 0
+        if empty.any():
+            xc = x0 + (numpy.arange(nx) + 0.5) * (x1 - x0) / nx
+            yc = y0 + (numpy.arange(ny) + 0.5) * (y1 - y0) / ny
+            xc, yc = [a.ravel()[empty] for a in numpy.meshgrid(xc, yc)]
+            lonlat = crs.PlateCarree().transform_points(projection, xc, yc)
+            on_globe = numpy.all(numpy.isfinite(lonlat[:, :2]), axis=1) & (numpy.abs(lonlat[:, 1]) <= 90)
+            __, nearest = get_point_tree(lon, lat).query(lonlat_to_xyz(lonlat[on_globe, 0], lonlat[on_globe, 1]))
+            fill[numpy.flatnonzero(empty)[on_globe]] = nearest
+        return numpy.concatenate([pixel, fill])
+    if cache:
+        key = array_key(lon, lat, projection=projection.proj4_init, extent=tuple(extent), shape=tuple(shape))
+        index = get_cached_array('raster_indices', key, _build)
+    else:
+        index = _build()
+    return index[:len(lon)], index[len(lon):]
+
+
+# KD-tree of the most recently used grid, shared by all projections
+_point_tree = {}
+
+
+def get_point_tree(lon, lat):
+    key = array_key(lon, lat)
+    if key not in _point_tree:
+        _point_tree.clear()
+        _point_tree[key] = cKDTree(lonlat_to_xyz(lon, lat))
+    return _point_tree[key]
+
+
+def rasterize(data, pixel, fill, shape):
+    '''
+    Average point values into pixels with numpy.bincount; pixels with no
+    points take the value of the nearest point, pixels off the globe are NaN
+    '''
+    data = numpy.asarray(data, dtype=numpy.float64)
+    valid = (pixel >= 0) & numpy.isfinite(data)
+    npixels = shape[0] * shape[1]
+    sums = numpy.bincount(pixel[valid], weights=data[valid], minlength=npixels)
+    counts = numpy.bincount(pixel[valid], minlength=npixels)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        image = numpy.where(counts > 0, sums / counts, numpy.nan)
+    image = numpy.where((counts == 0) & (fill >= 0), data[numpy.maximum(fill, 0)], image)
+    return image.reshape(shape)
+
+
+def get_raster_shape(axes):
+    # Size of the axes in output pixels
+    bbox = axes.get_window_extent()
+    return max(int(round(bbox.height)), 1), max(int(round(bbox.width)), 1)
+
+
+def plot_raster(axes, lon, lat, data, cache=True, **kwargs):
+    '''
+    Render unstructured data directly into an image matching the pixel grid
+    of a cartopy GeoAxes and show it with imshow, so rendering cost scales
+    with the number of pixels rather than the number of grid columns
+    '''
+    kwargs.pop('transform', None)
+    extent = axes.get_extent()
+    shape = get_raster_shape(axes)
+    pixel, fill = get_raster_index(lon, lat, axes.projection, extent, shape, cache=cache)
+    image = rasterize(data, pixel, fill, shape)
+    return axes.imshow(
+        image, origin='lower', extent=extent, transform=axes.projection,
+        interpolation='nearest', **kwargs
+    )
@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+import os, numpy, xarray, multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from disk_cache import get_cache_dir, file_key
+from e3smplot.e3sm_utils import get_data
+from stream_stats import QuantileSketch
+
+statistics = ('mean', 'min', 'max')
+
+# Bump to invalidate stored reductions when what is stored changes
+store_version = 2
+
+# Files are reduced in blocks of this many; partial results are merged in
+# block order, so results do not depend on the number of workers
+files_per_block = 8
+
+
+def get_fields(ds):
+    '''
+    Names of the (time, ncol) fields in a dataset
+    '''
+    return [v for v in ds.variables.keys() if ds[v].dims == ('time', 'ncol')]
+
+
+def reduce_dataset(ds, fields=None, time_sums=None, sketches=None):
+    '''
+    Area-weighted global mean, min and max at each time for (time, ncol)
+    fields of a dataset (all of them by default). Returns a small dataset in
+    which each field has dimensions (statistic, time). Fields are read one
+    time slice at a time; if a dict time_sums is given, per-column sums and
+    counts of valid values are accumulated into time_sums[field] from the
+    same reads, and likewise values are added to QuantileSketch histograms
+    in sketches[field] if a dict sketches is given.
+    '''
+    fields = get_fields(ds) if fields is None else fields
+    area = get_data(ds, 'area').values if fields else None
+    reduced = xarray.Dataset(coords={'statistic': list(statistics), 'time': ds['time'].values})
+    for v in fields:
+        d = get_data(ds, v)
+        values = numpy.full((len(statistics), len(ds['time'])), numpy.nan)
+        for i in range(len(ds['time'])):
+            x = d.isel(time=i).values
+            valid = numpy.isfinite(x)
+            if time_sums is not None:
+                total, count = time_sums.setdefault(v, [numpy.zeros(x.shape), numpy.zeros(x.shape, dtype=numpy.int64)])
+                total += numpy.where(valid, x, 0)
+                count += valid
+            if sketches is not None:
+                sketches.setdefault(v, QuantileSketch()).update(x)
+            if not valid.any(): continue
+            values[:, i] = (
+                numpy.sum(x[valid] * area[valid]) / numpy.sum(area[valid]),
+                x[valid].min(), x[valid].max(),
+            )
+        reduced[v] = xarray.DataArray(values, dims=('statistic', 'time'), attrs=d.attrs)
+    return reduced
+
+
+def add_sketches(reduced, sketches):
+    '''
+    Add histograms (QuantileSketch) of each field over all times to a
+    reduced dataset, as {field}_sketch variables of (side, bin, count) rows
+    '''
+    for v, sketch in sketches.items():
+        reduced[f'{v}_sketch'] = xarray.DataArray(sketch.to_array(), dims=(f'{v}_bin', 'sketch_entry'), attrs=sketch.attributes())
+    return reduced
+
+
+def get_sketches(reduced):
+    return {
+        v[:-len('_sketch')]: QuantileSketch.from_array(reduced[v].values, reduced[v].attrs)
+        for v in reduced.data_vars if v.endswith('_sketch')
+    }
+
+
+def reduce_file(path):
+    '''
+    Reductions (see reduce_dataset) of every (time, ncol) field in one file,
+    with a histogram of each field over all times (see add_sketches)
+    '''
+    sketches = {}
+    with xarray.open_dataset(path, use_cftime=True) as ds:
+        return add_sketches(reduce_dataset(ds, sketches=sketches), sketches)
+
+
+def get_store_path(path):
+    return os.path.join(get_cache_dir('reductions'), f'{file_key(path)}.v{store_version}.nc')
+
+
+def save_file_reductions(path, reduced):
+    store_path = get_store_path(path)
+    tmp_path = f'{store_path}.tmp{os.getpid()}'
+    reduced.to_netcdf(tmp_path)
+    os.replace(tmp_path, store_path)
+
+
+def get_file_reductions(path):
+    '''
+    Reductions for one file from the on-disk store, computing and saving them
+    first if the file is new or has changed since it was last reduced
+    '''
+    store_path = get_store_path(path)
+    if not os.path.exists(store_path):
+        save_file_reductions(path, reduce_file(path))
+    with xarray.open_dataset(store_path, use_cftime=True) as ds:
+        return ds.load()
+
+
+def map_blocks(function, blocks, workers=1):
+    '''
+    Apply function to each block of arguments, either here or on a pool of
+    worker processes, yielding results in block order
+    '''
+    workers = int(workers)
+    if workers <= 1:
+        yield from (function(*block) for block in blocks)
+        return
+    with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('fork')) as executor:
+        yield from executor.map(function, *zip(*blocks))
+
+
+def split_files(files):
+    return [files[i:i+files_per_block] for i in range(0, len(files), files_per_block)]
+
+
+def _store_file_reductions(files):
+    for f in files:
+        save_file_reductions(f, reduce_file(f))
+    return len(files)
+
+
+def get_reductions(files, workers=1):
+    '''
+    Per-time global mean, min and max of every (time, ncol) field across a set
+    of files, concatenated in time (an empty dataset if there are no files).
+    Only new or changed files are read (on workers processes if workers > 1);
+    the rest come from the store.
+    '''
+    return concat_reductions(_get_stored_reductions(files, workers))
+
+
+def get_histograms(files, workers=1):
+    '''
+    Histograms (QuantileSketch) of every (time, ncol) field over all times in
+    a set of files, merged from the per-file histograms in the store (which
+    are computed first for new or changed files, as in get_reductions)
+    '''
+    sketches = {}
+    for reduced in _get_stored_reductions(files, workers):
+        for v, sketch in get_sketches(reduced).items():
+            if v in sketches: sketches[v].merge(sketch)
+            else: sketches[v] = sketch
+    return sketches
+
+
+def _get_stored_reductions(files, workers):
+    todo = [f for f in files if not os.path.exists(get_store_path(f))]
+    for __ in map_blocks(_store_file_reductions, [(b,) for b in split_files(todo)], workers): pass
+    return [get_file_reductions(f) for f in files]
+
+
+def concat_reductions(reductions):
+    if len(reductions) == 0: return xarray.Dataset(coords={'statistic': list(statistics), 'time': []})
+    reductions = [r.drop_vars([v for v in r.data_vars if v.endswith('_sketch')]) for r in reductions]
+    return xarray.concat(reductions, dim='time', data_vars='minimal', coords='minimal', compat='override').sortby('time')
+
+
+def merge_time_sums(total, other):
+    '''
+    Add per-field (sum, count) time sums from other into total, in place
+    '''
+    for v, (s, n) in other.items():
+        if v in total:
+            total[v][0] += s
+            total[v][1] += n
+        else:
+            total[v] = [s, n]
+    return total
+
+
+def _reduce_file_block(files, fields):
+    # Partial reductions of a contiguous block of files
+    reductions, time_sums, coords = [], {}, None
+    for f in files:
+        with xarray.open_dataset(f, use_cftime=True) as ds:
+            all_fields = get_fields(ds)
+            file_fields = [v for v in all_fields if fields is None or v in fields]
+            # Histograms are only needed to store complete reductions
+            sketches = {} if file_fields == all_fields and not os.path.exists(get_store_path(f)) else None
+            reductions.append(reduce_dataset(ds, file_fields, time_sums, sketches))
+            if coords is None:
+                coords = {v: ds[v].load() for v in ds.variables if ds[v].dims == ('ncol',)}
+        if sketches is not None:
+            save_file_reductions(f, add_sketches(reductions[-1].copy(), sketches))
+    return reductions, time_sums, coords
+
+
+def reduce_files(files, fields=None, workers=1):
+    '''
+    Visit each file once and compute, for every selected (time, ncol) field
+    (all of them by default), both the per-time global mean, min and max (as
+    get_reductions) and the time mean at every column. Files reduced for all
+    their fields are added to the store on the way. With workers > 1, blocks
+    of files are reduced on a pool of worker processes and the partial
+    results merged. Returns (reductions, time_means); time_means also carries
+    the ncol variables of the first file (lon, lat, area, ...) as coordinates.
+    Both are empty if there are no files.
+    '''
+    reductions, time_sums, coords = [], {}, None
+    for r, t, c in map_blocks(_reduce_file_block, [(b, fields) for b in split_files(list(files))], workers):
+        reductions.extend(r)
+        merge_time_sums(time_sums, t)
+        if coords is None: coords = c
+    reductions = concat_reductions(reductions)
+    time_means = xarray.Dataset(coords=coords)
+    for v, (total, count) in time_sums.items():
+        mean = numpy.divide(total, count, out=numpy.full(total.shape, numpy.nan), where=count > 0)
+        time_means[v] = xarray.DataArray(mean, dims=('ncol',), attrs=reductions[v].attrs)
+    return reductions, time_means
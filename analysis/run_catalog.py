@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+import plac, os, hashlib, json, sqlite3, warnings
+from disk_cache import get_cache_dir
+from scan_files import scan_files, get_stream, is_history_file, scan_version
+
+schema = '''
+create table if not exists files (
+    path text primary key, stream text, size integer, mtime_ns integer,
+    status text, ntime integer, first_time text, last_time text,
+    time_start real, time_end real, grid text
+);
+create table if not exists variables (
+    path text, name text, dims text, shape text,
+    primary key (path, name)
+);
+create index if not exists files_by_stream on files (stream, time_start);
+'''
+
+
+def get_catalog_path(rundir):
+    # Catalogs built from older scans are not reused
+    key = hashlib.sha1(os.path.abspath(rundir).encode()).hexdigest()
+    return os.path.join(get_cache_dir('catalogs'), f'{key}.v{scan_version}.sqlite')
+
+
+class Catalog(object):
+    '''
+    SQLite index of the netCDF files in a run directory: for each file its
+    stream, time range, grid name and variables (with dimensions and
+    shapes). Call refresh() to pick up new, changed or removed files; queries
+    never open a netCDF file.
+    '''
+    def __init__(self, rundir, path=None):
+        self.rundir = os.path.abspath(rundir)
+        self.path = get_catalog_path(rundir) if path is None else path
+        self.db = sqlite3.connect(self.path)
+        self.db.executescript(schema)
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def refresh(self, workers=1):
+        '''
+        Scan files that are new or whose size or mtime have changed (see
+        scan_files.scan_file), and drop files that no longer exist. Returns
+        the number of files scanned and removed.
+        '''
+        on_disk = {
+            e.path: (e.stat().st_size, e.stat().st_mtime_ns)
+            for e in os.scandir(self.rundir) if e.name.endswith('.nc') and 'rhist' not in e.name
+        }
+        known = {p: (s, m) for p, s, m in self.db.execute('select path, size, mtime_ns from files')}
+        removed = [p for p in known if p not in on_disk]
+        todo = sorted(p for p, stat in on_disk.items() if known.get(p) != stat)
+        with self.db:
+            for p in removed + todo:
+                self.db.execute('delete from files where path = ?', (p,))
+                self.db.execute('delete from variables where path = ?', (p,))
+            for p, r in zip(todo, scan_files(todo, workers=workers)):
+                self.db.execute(
+                    'insert into files values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    (p, get_stream(p), *on_disk[p], r['status'], r.get('ntime'),
+                     r.get('first_time'), r.get('last_time'), r.get('time_start'), r.get('time_end'), r.get('grid')),
+                )
+                self.db.executemany(
+                    'insert into variables values (?, ?, ?, ?)',
+                    [(p, v, ','.join(dims), json.dumps(shape)) for v, (dims, shape) in r.get('variables', {}).items()],
+                )
+        return len(todo), len(removed)
+
+    def streams(self):
+        '''
+        Names of the history output streams in the run directory (restarts
+        and files not named like stream output are left out)
+        '''
+        return [s for s, path in self.db.execute('select stream, min(path) from files group by stream order by stream')
+                if is_history_file(path)]
+
+    def files(self, stream, start=None, end=None):
+        '''
+        Readable files of a stream in time order, optionally only those with
+        data from start up to (not including) end, given as ISO dates such as
+        '1995-06-01'. Files that failed the scan are left out with a warning (see
+        check_decadal.py for details).
+        '''
+        failed = self.db.execute(
+            "select status, count(*) from files where stream = ? and status != 'ok' group by status", (stream,)).fetchall()
+        if failed:
+            warnings.warn(f'Skipping files of {stream} that failed the scan: ' + ', '.join(f'{n} {s}' for s, n in failed))
+        query = "select path from files where stream = ? and status = 'ok' and ntime > 0"
+        args = [stream]
+        if start is not None:
+            query += ' and last_time >= ?'
+            args.append(start)
+        if end is not None:
+            query += ' and first_time < ?'
+            args.append(end)
+        return [p for p, in self.db.execute(query + ' order by time_start', args)]
+
+    def fields(self, stream, dims=('time', 'ncol')):
+        '''
+        Names of the variables in a stream with the given dimensions
+        '''
+        return [v for v, in self.db.execute(
+            'select distinct name from variables join files using (path) '
+            'where stream = ? and dims = ? order by name', (stream, ','.join(dims)))]
+
+    def stream_info(self, stream):
+        '''
+        Summary of a stream: number of files, time range, grid and the
+        dimensions and shape (from its first file) of every variable
+        '''
+        nfiles, first_time, last_time, grid = self.db.execute(
+            "select count(*), min(first_time), max(last_time), max(grid) from files "
+            "where stream = ? and status = 'ok'", (stream,)).fetchone()
+        variables = {
+            v: dict(dims=tuple(d.split(',')) if d else (), shape=tuple(json.loads(s)))
+            for v, d, s in self.db.execute(
+                'select name, dims, shape from variables where path = ('
+                "select path from files where stream = ? and status = 'ok' order by time_start limit 1)", (stream,))
+        }
+        return dict(nfiles=nfiles, first_time=first_time, last_time=last_time, grid=grid, variables=variables)
+
+
+@plac.opt('workers', 'number of worker processes for scanning files', type=int)
+def main(rundir, workers=1):
+    '''
+    Build or refresh the catalog of a run directory and list its streams
+    '''
+    with Catalog(rundir) as catalog:
+        nscanned, nremoved = catalog.refresh(workers=workers)
+        print(f'Scanned {nscanned} files, removed {nremoved}; catalog in {catalog.path}')
+        for stream in catalog.streams():
+            info = catalog.stream_info(stream)
+            print(f"{stream}: {info['nfiles']} files, {info['first_time']} -- {info['last_time']}, grid {info['grid']}")
+
+
+if __name__ == '__main__':
+    plac.call(main)
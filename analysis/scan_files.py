@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+import os, re, json, struct, numpy, netCDF4, cftime, multiprocessing
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from disk_cache import get_cache_dir, file_key
+
+# Times are compared as days since this date in each file's calendar
+time_units = 'days since 1970-01-01'
+
+# Bump to invalidate cached scans when what a scan records changes
+scan_version = 2
+
+# Output files are named {stream}.YYYY-MM-DD-SSSSS.nc
+_stream_pattern = re.compile(r'^(.*)\.(\d{4}-\d{2}-\d{2}-\d{5})\.nc$')
+
+# Restart and restart history streams, e.g. case.scream.r, case.eam.rh0
+_restart_pattern = re.compile(r'\.(r|rs|rst|rh\d*|rhist)$')
+
+
+def get_stream(path):
+    match = _stream_pattern.match(os.path.basename(path))
+    return match.group(1) if match else os.path.basename(path)
+
+
+def is_history_file(path):
+    '''
+    True for files named like history output ({stream}.YYYY-MM-DD-SSSSS.nc),
+    other than restarts
+    '''
+    match = _stream_pattern.match(os.path.basename(path))
+    return match is not None and not _restart_pattern.search(match.group(1))
+
+
+def infer_grid_name(dims):
+    '''
+    Guess the grid name from dimension sizes: neXXpg2 for unstructured
+    physics grids with 6 x 4 x ne**2 columns, NLATxNLON for lat/lon grids
+    '''
+    if 'ncol' in dims:
+        ne = int(round(numpy.sqrt(dims['ncol'] / 24)))
+        return f'ne{ne}pg2' if 24 * ne**2 == dims['ncol'] else f'ncol{dims["ncol"]}'
+    if 'lat' in dims and 'lon' in dims:
+        return f'{dims["lat"]}x{dims["lon"]}'
+    return None
+
+
+# Sizes of the netCDF classic format external types, by type code
+_classic_type_sizes = {1: 1, 2: 1, 3: 2, 4: 4, 5: 4, 6: 8, 7: 1, 8: 2, 9: 4, 10: 8, 11: 8}
+
+
+def get_classic_size(path):
+    '''
+    Minimum size a netCDF classic format file (CDF1, CDF2 or CDF5) must have
+    to hold all of its data, from the header: the end of the last
+    non-record variable or of the last record. Returns None for files whose
+    number of records was not written (still being written by a stream).
+    '''
+    with open(path, 'rb') as f:
+        magic = f.read(4)
+        if magic[:3] != b'CDF' or magic[3] not in (1, 2, 5):
+            raise ValueError(f'{path} is not a netCDF classic format file')
+        version = magic[3]
+
+        def read(fmt):
+            fmt = '>' + fmt
+            return struct.unpack(fmt, f.read(struct.calcsize(fmt)))[0]
+        read_count = lambda: read('q' if version == 5 else 'i')
+        read_offset = lambda: read('i' if version == 1 else 'q')
+        def read_name():
+            n = read_count()
+            return f.read(n + (-n % 4))[:n]
+        def skip_attrs():
+            read('i')
+            for i in range(read_count()):
+                read_name()
+                nc_type = read('i')
+                n = read_count() * _classic_type_sizes[nc_type]
+                f.seek(n + (-n % 4), 1)
+
+        numrecs = read_count()
+        if numrecs in (-1, 2**32 - 1): return None
+        read('i')
+        dims = []
+        for i in range(read_count()):
+            read_name()
+            dims.append(read_count())
+        skip_attrs()
+        read('i')
+        variables = []
+        for i in range(read_count()):
+            read_name()
+            dimids = [read_count() for j in range(read_count())]
+            skip_attrs()
+            nc_type = read('i')
+            read_count()
+            begin = read_offset()
+            # vsize in the header is clamped for very large variables, so work
+            # it out from the dimensions; a record dimension has length 0
+            is_record = len(dimids) > 0 and dims[dimids[0]] == 0
+            size = int(numpy.prod([dims[d] for d in dimids[is_record:]])) * _classic_type_sizes[nc_type]
+            variables.append((is_record, begin, size))
+
+    # Each record holds every record variable padded to 4 bytes, except when
+    # there is only one record variable
+    record_sizes = [size for is_record, begin, size in variables if is_record]
+    recsize = record_sizes[0] if len(record_sizes) == 1 else sum(s + (-s % 4) for s in record_sizes)
+    ends = [begin + size for is_record, begin, size in variables if not is_record]
+    if numrecs > 0:
+        ends += [begin + (numrecs - 1) * recsize + size for is_record, begin, size in variables if is_record]
+    return max(ends, default=0)
+
+
+def _scan_file(path):
+    # Read what we need from the header, plus the time values
+    result = dict(path=os.path.abspath(path), size=os.path.getsize(path), status='ok', error=None)
+    if result['size'] == 0:
+        result['status'] = 'empty'
+        return result
+    try:
+        nc = netCDF4.Dataset(path)
+    except Exception as e:
+        result.update(status='unreadable', error=str(e))
+        return result
+    with nc:
+        result['dims'] = {d: len(nc.dimensions[d]) for d in nc.dimensions}
+        result['variables'] = {v: [list(var.dimensions), list(var.shape)] for v, var in nc.variables.items()}
+        result['grid'] = infer_grid_name(result['dims'])
+        if 'time' not in nc.variables: return result
+        try:
+            time = nc.variables['time']
+            values = time[:]
+            ntime = len(values)
+            result['ntime'] = ntime
+            if ntime == 0: return result
+            # Reading past the end of a classic file gives fill values rather
+            # than an error, so check the file is long enough for all of its
+            # records
+            if nc.data_model.startswith('NETCDF3'):
+                expected_size = get_classic_size(path)
+                if expected_size is not None and result['size'] < expected_size:
+                    raise ValueError(f'file is {result["size"]} bytes but its header needs {expected_size}')
+        except Exception as e:
+            result.update(status='truncated', error=str(e))
+            return result
+        try:
+            calendar = getattr(time, 'calendar', 'standard')
+            dates = cftime.num2date(values, time.units, calendar)
+            days = cftime.date2num(dates, time_units, calendar)
+        except Exception as e:
+            result.update(status='unreadable', error=f'could not decode times: {e}')
+            return result
+        result.update(
+            calendar=calendar,
+            time_start=float(days[0]), time_end=float(days[-1]),
+            time_step=float(numpy.median(numpy.diff(days))) if ntime > 1 else None,
+            first_time=dates[0].isoformat(), last_time=dates[-1].isoformat(),
+        )
+    return result
+
+
+def scan_file(path):
+    '''
+    Header-level summary of one output file: size, status ('ok', 'empty',
+    'unreadable' or 'truncated'), dimension sizes, variables (with their
+    dimensions and shapes), grid name and time range. Cached by
+    path, size and modification time, so unchanged files are not reopened.
+    '''
+    cache_path = os.path.join(get_cache_dir('scans'), f'{file_key(path)}.v{scan_version}.json')
+    if os.path.exists(cache_path):
+        with open(cache_path) as f: return json.load(f)
+    result = _scan_file(path)
+    tmp_path = f'{cache_path}.tmp{os.getpid()}'
+    with open(tmp_path, 'w') as f: json.dump(result, f)
+    os.replace(tmp_path, cache_path)
+    return result
+
+
+def scan_files(files, workers=1):
+    '''
+    Scan a list of files (see scan_file), on workers processes if workers > 1
+    '''
+    workers = int(workers)
+    if workers <= 1: return [scan_file(f) for f in files]
+    with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('fork')) as executor:
+        return list(executor.map(scan_file, files, chunksize=16))
+
+
+def check_stream(results):
+    '''
+    Look for problems across the files of one stream: time gaps and overlaps
+    between consecutive files, and dimension sizes that differ from what
+    most files in the stream have
+    '''
+    timed = sorted([r for r in results if r.get('time_start') is not None], key=lambda r: r['time_start'])
+    steps = [r['time_step'] for r in timed if r.get('time_step')]
+    starts = numpy.diff([r['time_start'] for r in timed])
+    step = numpy.median(steps) if steps else (numpy.median(starts) if len(starts) else None)
+    gaps, overlaps = [], []
+    for prev, this in zip(timed[:-1], timed[1:]):
+        if this['time_start'] <= prev['time_end']:
+            overlaps.append(dict(files=[prev['path'], this['path']], start=this['first_time'], end=prev['last_time']))
+        elif step and this['time_start'] - prev['time_end'] > 1.5 * step:
+            gaps.append(dict(files=[prev['path'], this['path']], start=prev['last_time'], end=this['first_time']))
+
+    # Expected size of each (non-time) dimension is the most common one
+    sizes = defaultdict(Counter)
+    for r in results:
+        for d, n in r.get('dims', {}).items():
+            if d != 'time': sizes[d][n] += 1
+    expected = {d: c.most_common(1)[0][0] for d, c in sizes.items()}
+    unexpected_dims = [
+        dict(path=r['path'], dim=d, size=n, expected=expected[d])
+        for r in results for d, n in r.get('dims', {}).items()
+        if d != 'time' and n != expected[d]
+    ]
+    return dict(
+        nfiles=len(results),
+        first_time=timed[0]['first_time'] if timed else None,
+        last_time=timed[-1]['last_time'] if timed else None,
+        time_step=step, dims=expected,
+        gaps=gaps, overlaps=overlaps, unexpected_dims=unexpected_dims,
+    )
+
+
+def get_report(files, workers=1):
+    '''
+    Scan files and build a machine-readable report: per-file results, checks
+    for each stream, and a flat list of problems
+    '''
+    results = scan_files(files, workers=workers)
+    streams = defaultdict(list)
+    for r in results: streams[get_stream(r['path'])].append(r)
+    stream_checks = {s: check_stream(r) for s, r in sorted(streams.items())}
+    problems = [dict(kind=r['status'], path=r['path'], error=r['error']) for r in results if r['status'] != 'ok']
+    problems += [dict(kind='zero_time', path=r['path']) for r in results if r.get('ntime') == 0]
+    for s, c in stream_checks.items():
+        problems += [dict(kind='gap', stream=s, **g) for g in c['gaps']]
+        problems += [dict(kind='overlap', stream=s, **o) for o in c['overlaps']]
+        problems += [dict(kind='unexpected_dim', stream=s, **u) for u in c['unexpected_dims']]
+    return dict(files=results, streams=stream_checks, problems=problems)
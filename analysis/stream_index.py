@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+import plac, os, hashlib, json, threading, numpy, xarray, netCDF4, cftime
+from xarray.backends import BackendArray
+from xarray.core import indexing
+from disk_cache import get_cache_dir
+from scan_files import get_stream
+from run_catalog import Catalog
+
+# netCDF/HDF5 is not thread safe, and dask reads chunks from several threads
+_read_lock = threading.Lock()
+
+
+def get_index_path(files):
+    '''
+    Location of the index for the stream(s) a set of files belongs to
+    '''
+    streams = sorted(set((os.path.dirname(os.path.abspath(f)), get_stream(f)) for f in files))
+    key = hashlib.sha1(repr(streams).encode()).hexdigest()
+    return os.path.join(get_cache_dir('stream_indexes'), f'{key}.json')
+
+
+def _to_json(value):
+    return value.tolist() if isinstance(value, (numpy.ndarray, numpy.generic)) else value
+
+
+def _read_schema(path):
+    # Dimensions, decoded dtype and attributes of every variable in a file
+    with xarray.open_dataset(path, decode_times=False) as ds:
+        return dict(
+            attrs={k: _to_json(v) for k, v in ds.attrs.items()},
+            coords=[c for c in ds.coords],
+            variables={
+                v: dict(dims=list(ds[v].dims), shape=list(ds[v].shape), dtype=ds[v].dtype.str,
+                        attrs={k: _to_json(a) for k, a in ds[v].attrs.items()})
+                for v in ds.variables
+            },
+        )
+
+
+def _read_times(path, units, calendar):
+    # Time values of a file in the index's units
+    with netCDF4.Dataset(path) as nc:
+        time = nc.variables['time']
+        values = numpy.asarray(time[:], dtype=numpy.float64)
+        if time.units != units or getattr(time, 'calendar', 'standard') != calendar:
+            values = cftime.date2num(cftime.num2date(values, time.units, getattr(time, 'calendar', 'standard')), units, calendar)
+    return [float(t) for t in values]
+
+
+def update_index(files):
+    '''
+    Build the index for a set of files, or add any files that are new or
+    have changed to an existing one. Only the first file's header and the
+    time values of new files are read. Returns the index (a dict that is also
+    saved as JSON).
+    '''
+    path = get_index_path(files)
+    index = None
+    if os.path.exists(path):
+        with open(path) as f: index = json.load(f)
+    if index is None:
+        index = _read_schema(files[0])
+        time_attrs = index['variables']['time']['attrs']
+        index['time_units'] = time_attrs['units']
+        index['calendar'] = time_attrs.get('calendar', 'standard')
+        index['files'] = {}
+    changed = False
+    for f in files:
+        f = os.path.abspath(f)
+        stat = os.stat(f)
+        entry = index['files'].get(f)
+        if entry is not None and (entry['size'], entry['mtime_ns']) == (stat.st_size, stat.st_mtime_ns): continue
+        index['files'][f] = dict(size=stat.st_size, mtime_ns=stat.st_mtime_ns,
+                                 time=_read_times(f, index['time_units'], index['calendar']))
+        changed = True
+    if changed:
+        tmp_path = f'{path}.tmp{os.getpid()}'
+        with open(tmp_path, 'w') as f: json.dump(index, f)
+        os.replace(tmp_path, path)
+    return index
+
+
+class StreamArray(BackendArray):
+    '''
+    Lazily indexed variable spanning the files of a stream along time (or,
+    for variables without a time dimension, read from the first file)
+    '''
+    def __init__(self, paths, counts, name, shape, dtype):
+        self.paths = paths
+        self.offsets = numpy.concatenate([[0], numpy.cumsum(counts)]) if counts is not None else None
+        self.name = name
+        self.shape = tuple(shape)
+        self.dtype = numpy.dtype(dtype)
+
+    def __dask_tokenize__(self):
+        return (type(self).__name__, self.paths, self.name, self.shape, self.dtype.str)
+
+    def __getitem__(self, key):
+        return indexing.explicit_indexing_adapter(key, self.shape, indexing.IndexingSupport.BASIC, self._getitem)
+
+    def _read(self, path, key):
+        with _read_lock, netCDF4.Dataset(path) as nc:
+            values = nc.variables[self.name][key]
+        if numpy.ma.isMaskedArray(values):
+            values = values.astype(self.dtype).filled(numpy.nan if self.dtype.kind == 'f' else 0)
+        return numpy.asarray(values, dtype=self.dtype)
+
+    def _getitem(self, key):
+        if self.offsets is None: return self._read(self.paths[0], key)
+
+        # Read the requested time indices from each file that has any
+        itime, rest = key[0], key[1:]
+        indices = numpy.arange(self.shape[0])[itime]
+        parts = []
+        for i, path in enumerate(self.paths):
+            local = numpy.atleast_1d(indices)
+            local = local[(local >= self.offsets[i]) & (local < self.offsets[i+1])] - self.offsets[i]
+            if len(local) == 0: continue
+            values = self._read(path, (slice(local.min(), local.max() + 1),) + rest)
+            parts.append(values[local - local.min()])
+        values = numpy.concatenate(parts, axis=0) if parts else numpy.zeros((0,) + self.shape[1:], self.dtype)[(slice(None),) + rest]
+        return values[0] if numpy.ndim(indices) == 0 else values
+
+
+def open_index(index, files=None):
+    '''
+    Open the files of an index (or a subset, files) as one lazy dataset,
+    chunked one file per chunk along time as open_mfdataset would be
+    '''
+    paths = sorted(index['files'] if files is None else [os.path.abspath(f) for f in files],
+                   key=lambda f: index['files'][f]['time'][0] if index['files'][f]['time'] else numpy.inf)
+    counts = [len(index['files'][f]['time']) for f in paths]
+    times = numpy.concatenate([index['files'][f]['time'] for f in paths] or [[]])
+    variables = {}
+    for v, schema in index['variables'].items():
+        attrs = dict(schema['attrs'])
+        if v == 'time':
+            for k in ('units', 'calendar'): attrs.pop(k, None)
+            variables[v] = xarray.Variable(('time',), cftime.num2date(times, index['time_units'], index['calendar']), attrs,
+                                           encoding=dict(units=index['time_units'], calendar=index['calendar']))
+            continue
+        timed = schema['dims'][:1] == ['time']
+        shape = [len(times)] + schema['shape'][1:] if timed else schema['shape']
+        array = StreamArray(paths, counts if timed else None, v, shape, schema['dtype'])
+        variables[v] = xarray.Variable(schema['dims'], indexing.LazilyIndexedArray(array), attrs)
+    coords = {c: variables.pop(c) for c in index['coords'] if c in variables}
+    ds = xarray.Dataset(variables, coords=coords, attrs=index['attrs'])
+    return ds.chunk({'time': tuple(counts)})
+
+
+def open_stream(*files):
+    '''
+    Open a set of files lazily through their stream index, building it or
+    adding new files to it first. Much faster than open_mfdataset once the
+    index exists, since no file is opened until data are read. Files
+    without a time axis are opened with open_mfdataset instead.
+    '''
+    with netCDF4.Dataset(files[0]) as nc:
+        if 'time' not in nc.variables:
+            return xarray.open_mfdataset(files, use_cftime=True, data_vars='minimal', coords='minimal', compat='override')
+    return open_index(update_index(files), files)
+
+
+def index_catalog(catalog):
+    '''
+    Build or update the index of every stream in a run directory catalog
+    (see run_catalog), using the catalog's file lists
+    '''
+    return {stream: update_index(catalog.files(stream)) for stream in catalog.streams() if catalog.files(stream)}
+
+
+@plac.opt('rundir', 'index every stream of this run directory (refreshing its catalog first)')
+def main(rundir=None, *files):
+    '''
+    Build or update the index for a set of files, or for each stream of a
+    run directory
+    '''
+    if rundir is not None:
+        with Catalog(rundir) as catalog:
+            catalog.refresh()
+            for stream, index in index_catalog(catalog).items():
+                print(f"{stream}: indexed {len(index['files'])} files")
+    if files:
+        index = update_index(files)
+        print(f"Indexed {len(index['files'])} files in {get_index_path(files)}")
+
+
+if __name__ == '__main__':
+    plac.call(main)
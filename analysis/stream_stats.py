@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+import copy, numpy, dask, dask.array, functools
+
+# Width of the finest histogram bins, as the log of the ratio of their edges
+_log_gamma = numpy.log1p(2.0**-40)
+
+
+class QuantileSketch(object):
+    '''
+    Mergeable one-pass summary of a stream of values: exact count, NaN count,
+    min and max, plus a sparse histogram for approximate quantiles. Bins are
+    logarithmically spaced, as in DDSketch: positive and negative values fall
+    in separate bins with edges at powers of gamma, and zeros are counted
+    exactly, so quantiles have a bounded relative error however skewed the
+    data are. Bins start with gamma = 1 + 2**-40; whenever more than max_bins
+    bins are occupied, neighbouring pairs are merged (squaring gamma), so
+    bins are as fine as the spread of magnitudes in the data allows. Bin
+    indices at every level follow exactly from the finest one, so sketches
+    can always be merged exactly. Quantiles are accurate to a relative error
+    of about gamma - 1.
+    '''
+    def __init__(self, max_bins=2048):
+        self.max_bins = int(max_bins)
+        self.count = 0
+        self.nan_count = 0
+        self.zero_count = 0
+        self._min = numpy.inf
+        self._max = -numpy.inf
+        self.level = 0
+        # Bin indices and counts for positive and negative values; bin k at
+        # level m holds magnitudes in (gamma**(k-1), gamma**k], with gamma =
+        # (1 + 2**-40)**(2**m)
+        self.bins = [numpy.zeros(0, dtype=numpy.int64) for side in range(2)]
+        self.counts = [numpy.zeros(0, dtype=numpy.int64) for side in range(2)]
+
+    @property
+    def min(self):
+        '''
+        Smallest non-NaN value, or NaN if there are none (as numpy.nanmin)
+        '''
+        return self._min if self.count > 0 else numpy.nan
+
+    @property
+    def max(self):
+        '''
+        Largest non-NaN value, or NaN if there are none (as numpy.nanmax)
+        '''
+        return self._max if self.count > 0 else numpy.nan
+
+    @property
+    def gamma(self):
+        return numpy.exp(_log_gamma * 2**self.level)
+
+    def _coarsen(self, level):
+        # Merge bins into wider ones: at the next level, gamma is squared and
+        # bin k becomes ceil(k / 2)
+        for side in range(2):
+            self.bins[side], inverse = numpy.unique(-((-self.bins[side]) >> (level - self.level)), return_inverse=True)
+            self.counts[side] = numpy.bincount(inverse, weights=self.counts[side], minlength=len(self.bins[side])).astype(numpy.int64)
+        self.level = level
+
+    def _add_bins(self, side, bins, counts):
+        bins, inverse = numpy.unique(numpy.concatenate([self.bins[side], bins]), return_inverse=True)
+        self.counts[side] = numpy.bincount(inverse, weights=numpy.concatenate([self.counts[side], counts]), minlength=len(bins)).astype(numpy.int64)
+        self.bins[side] = bins
+
+    def _limit_bins(self):
+        while len(self.bins[0]) + len(self.bins[1]) > self.max_bins:
+            self._coarsen(self.level + 1)
+
+    def update(self, values):
+        values = numpy.asarray(values, dtype=numpy.float64).ravel()
+        finite = numpy.isfinite(values)
+        self.nan_count += int(numpy.isnan(values).sum())
+        values = values[finite]
+        if len(values) == 0: return self
+        self.count += len(values)
+        self._min = min(self._min, values.min())
+        self._max = max(self._max, values.max())
+        self.zero_count += int(numpy.count_nonzero(values == 0))
+        for side, magnitudes in enumerate((values[values > 0], -values[values < 0])):
+            if len(magnitudes) == 0: continue
+            index = numpy.ceil(numpy.log(magnitudes) / _log_gamma).astype(numpy.int64)
+
+            # Coarsen until the new values span a bounded number of bins, so
+            # that a dense bincount is cheaper than sorting the values
+            level, span = self.level, int(index.max() - index.min())
+            while (span >> level) >= 16 * self.max_bins: level += 1
+            self._coarsen(level)
+            index = -((-index) >> self.level)
+            offset = index.min()
+            counts = numpy.bincount(index - offset)
+            occupied = numpy.flatnonzero(counts)
+            self._add_bins(side, occupied + offset, counts[occupied])
+        self._limit_bins()
+        return self
+
+    def merge(self, other):
+        '''
+        Add the values summarized by another sketch to this one (in place);
+        the result does not depend on the order sketches are merged in
+        '''
+        self.count += other.count
+        self.nan_count += other.nan_count
+        self.zero_count += other.zero_count
+        if other.count == 0: return self
+        self._min = min(self._min, other._min)
+        self._max = max(self._max, other._max)
+        other = other.copy()
+        level = max(self.level, other.level)
+        self._coarsen(level)
+        other._coarsen(level)
+        for side in range(2):
+            self._add_bins(side, other.bins[side], other.counts[side])
+        self._limit_bins()
+        return self
+
+    def copy(self):
+        return copy.deepcopy(self)
+
+    def to_array(self):
+        '''
+        Occupied bins as rows of (side, bin, count), with side 0 for positive
+        and 1 for negative values; with attributes() this is all that is needed
+        to rebuild the sketch (see from_array)
+        '''
+        return numpy.concatenate([
+            numpy.stack([numpy.full(len(self.bins[side]), side), self.bins[side], self.counts[side]], axis=-1)
+            for side in range(2)
+        ]).astype(numpy.int64)
+
+    def attributes(self):
+        return dict(max_bins=self.max_bins, level=self.level, count=self.count, nan_count=self.nan_count,
+                    zero_count=self.zero_count, min=self._min, max=self._max)
+
+    @classmethod
+    def from_array(cls, array, attributes):
+        sketch = cls(attributes['max_bins'])
+        for k in ('level', 'count', 'nan_count', 'zero_count'): setattr(sketch, k, int(attributes[k]))
+        sketch._min, sketch._max = float(attributes['min']), float(attributes['max'])
+        array = numpy.asarray(array, dtype=numpy.int64).reshape(-1, 3)
+        for side in range(2):
+            rows = array[array[:, 0] == side]
+            sketch.bins[side], sketch.counts[side] = rows[:, 1].copy(), rows[:, 2].copy()
+        return sketch
+
+    def quantile(self, q):
+        '''
+        Approximate quantile(s) q (0 to 1) of the non-NaN values, interpolating
+        linearly within bins as numpy.nanquantile does between values
+        '''
+        q = numpy.asarray(q, dtype=numpy.float64)
+        if self.count == 0: return numpy.full(q.shape, numpy.nan)[()]
+
+        # Bin edges and counts in increasing order of value: negative values
+        # from the largest magnitude down, then zeros, then positive values
+        log_gamma = _log_gamma * 2**self.level
+        negative, positive = self.bins[1][::-1], self.bins[0]
+        with numpy.errstate(over='ignore'):
+            lower = numpy.concatenate([-numpy.exp(negative * log_gamma), [0], numpy.exp((positive - 1) * log_gamma)])
+            upper = numpy.concatenate([-numpy.exp((negative - 1) * log_gamma), [0], numpy.exp(positive * log_gamma)])
+        counts = numpy.concatenate([self.counts[1][::-1], [self.zero_count], self.counts[0]])
+
+        position = q * (self.count - 1)
+        cumulative = numpy.cumsum(counts)
+        j = numpy.minimum(numpy.searchsorted(cumulative, position, side='right'), len(cumulative) - 1)
+        before = cumulative[j] - counts[j]
+        fraction = numpy.minimum((position - before + 0.5) / counts[j], 1)
+        with numpy.errstate(invalid='ignore'):
+            value = lower[j] + fraction * (upper[j] - lower[j])
+        return numpy.clip(value, self._min, self._max)[()]
+
+    def percentile(self, p):
+        return self.quantile(numpy.asarray(p) / 100.0)
+
+
+class SummaryStats(QuantileSketch):
+    '''
+    QuantileSketch that also accumulates a (weighted) sum, so that min, max,
+    NaN count, mean and quantiles all come out of the same pass over the data
+    '''
+    def __init__(self, max_bins=2048):
+        super().__init__(max_bins)
+        self.weighted_sum = 0.0
+        self.total_weight = 0.0
+
+    def update(self, values, weights=None):
+        values = numpy.asarray(values, dtype=numpy.float64)
+        weights = numpy.ones(values.shape) if weights is None else numpy.broadcast_to(weights, values.shape)
+        valid = numpy.isfinite(values)
+        self.weighted_sum += float(numpy.sum(values[valid] * weights[valid]))
+        self.total_weight += float(numpy.sum(weights[valid]))
+        return super().update(values)
+
+    def merge(self, other):
+        self.weighted_sum += other.weighted_sum
+        self.total_weight += other.total_weight
+        return super().merge(other)
+
+    @property
+    def mean(self):
+        '''
+        Weighted mean over non-NaN values, matching area_average
+        '''
+        return self.weighted_sum / self.total_weight if self.total_weight > 0 else numpy.nan
+
+
+def _block_stats(values, weights, max_bins):
+    return SummaryStats(max_bins).update(values, weights)
+
+
+# Results of previous calls to get_stats, keyed by a dask token of the inputs
+_stats_cache = {}
+_stats_cache_size = 32
+
+
+def get_stats(*data_arrays, weights=None, max_bins=2048):
+    '''
+    Summary statistics (SummaryStats) for one or more DataArrays, computed
+    together in a single dask.compute: each block of each array is reduced to
+    a small partial result, and partial results are merged afterwards. Arrays
+    derived from the same files (e.g. a difference and its operands) share
+    their reads. weights is None, one DataArray, or one per data array.
+    Results are cached, so asking again for the same arrays is free.
+    '''
+    if weights is None or not isinstance(weights, (list, tuple)):
+        weights = [weights] * len(data_arrays)
+    keys = [dask.base.tokenize(d, w, max_bins) for d, w in zip(data_arrays, weights)]
+
+    # Build per-block partial results for everything that is not cached yet
+    todo = {}
+    for key, data, w in zip(keys, data_arrays, weights):
+        if key in _stats_cache or key in todo: continue
+        d = dask.array.asarray(data.data)
+        if w is None:
+            blocks = [(b, None) for b in d.to_delayed(optimize_graph=False).ravel()]
+        else:
+            w = dask.array.asarray(w.broadcast_like(data).transpose(*data.dims).data).rechunk(d.chunks)
+            blocks = zip(d.to_delayed(optimize_graph=False).ravel(), w.to_delayed(optimize_graph=False).ravel())
+        todo[key] = [dask.delayed(_block_stats)(b, wb, max_bins) for b, wb in blocks]
+    if todo:
+        results = dask.compute(todo)[0]
+        for key, partials in results.items():
+            _stats_cache[key] = functools.reduce(lambda a, b: a.merge(b), partials)
+            while len(_stats_cache) > _stats_cache_size:
+                _stats_cache.pop(next(iter(_stats_cache)))
+    return [_stats_cache[key] for key in keys]
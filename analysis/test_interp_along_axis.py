@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+
+import numpy
+from apply_map import interp_along_axis
+
+
+def reference(xout, xin, yin, axis=0, left=None, right=None, log=False):
+    # Apply numpy.interp to each 1D slice (flipping decreasing slices, since
+    # numpy.interp requires increasing xp)
+    xin = numpy.moveaxis(numpy.broadcast_to(xin, yin.shape), axis, -1)
+    yin = numpy.moveaxis(yin, axis, -1)
+    if log: xin, xout = numpy.log(xin), numpy.log(xout)
+    yout = numpy.empty(yin.shape[:-1] + (len(xout),))
+    for index in numpy.ndindex(*yin.shape[:-1]):
+        x, y = xin[index], yin[index]
+        if x[0] > x[-1]: x, y = x[::-1], y[::-1]
+        yout[index] = numpy.interp(xout, x, y, left=left, right=right)
+    return numpy.moveaxis(yout, -1, axis)
+
+
+def make_inputs(shape, axis, decreasing, seed=0):
+    # Random monotonic coordinates along axis with random data
+    rng = numpy.random.default_rng(seed)
+    xin = numpy.cumsum(rng.uniform(0.1, 1.0, shape), axis=axis)
+    if decreasing: xin = numpy.flip(xin, axis=axis)
+    yin = rng.normal(size=shape)
+    return xin, yin
+
+
+def test_interp_along_axis():
+    shape = (7, 5, 12)
+    for axis in range(len(shape)):
+        for decreasing in (False, True):
+            xin, yin = make_inputs(shape, axis, decreasing)
+            # Points inside, outside and exactly on the input coordinates
+            xout = numpy.concatenate([
+                numpy.linspace(xin.min() - 1, xin.max() + 1, 9),
+                numpy.take(xin, [0, 3], axis=axis).ravel()[:2],
+            ])
+            for left, right in ((None, None), (numpy.nan, numpy.nan), (-1.0, 2.0)):
+                numpy.testing.assert_allclose(
+                    interp_along_axis(xout, xin, yin, axis=axis, left=left, right=right, block_size=4),
+                    reference(xout, xin, yin, axis=axis, left=left, right=right),
+                    rtol=1e-12, atol=1e-12,
+                )
+
+
+def test_interp_along_axis_log():
+    xin, yin = make_inputs((4, 6, 30), 2, True)
+    xin = 1000 * xin
+    xout = numpy.array([850., 500., 200., 10.])
+    numpy.testing.assert_allclose(
+        interp_along_axis(xout, xin, yin, axis=2, left=numpy.nan, right=numpy.nan, log=True),
+        reference(xout, xin, yin, axis=2, left=numpy.nan, right=numpy.nan, log=True),
+        rtol=1e-12, atol=1e-12,
+    )
+
+
+if __name__ == '__main__':
+    test_interp_along_axis()
+    test_interp_along_axis_log()
+    print('done')
@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+
+import os, tempfile, numpy, netCDF4
+import disk_cache
+from scan_files import get_classic_size, scan_files, check_stream
+
+
+def write_file(path, format, start, ntime=4, ncol=7):
+    # A small stream file: record variables of several types (including one
+    # with a size that needs padding) and non-record variables
+    with netCDF4.Dataset(path, 'w', format=format) as nc:
+        nc.createDimension('time', None)
+        nc.createDimension('ncol', ncol)
+        nc.createDimension('lev', 3)
+        time = nc.createVariable('time', 'f8', ('time',))
+        time.units = 'days since 1994-10-01'
+        time.calendar = 'noleap'
+        time[:] = start + numpy.arange(ntime) / ntime
+        nc.createVariable('area', 'f8', ('ncol',))[:] = 1.0
+        nc.createVariable('T_2m', 'f4', ('time', 'ncol'))[:] = 280.0
+        nc.createVariable('flag', 'i2', ('time', 'ncol'))[:] = 1
+        nc.createVariable('Q', 'f4', ('time', 'ncol', 'lev'))[:] = 1e-3
+
+
+def test_scan_files():
+    with tempfile.TemporaryDirectory() as directory:
+        disk_cache.cache_root = os.path.join(directory, 'cache')
+        files = []
+        for i, format in enumerate(('NETCDF3_CLASSIC', 'NETCDF3_64BIT_OFFSET', 'NETCDF3_64BIT_DATA')):
+            files.append(os.path.join(directory, f'output.scream.test.1994-10-0{i+1}-00000.nc'))
+            write_file(files[-1], format, start=i)
+            # A complete file is exactly as long as its header says
+            assert get_classic_size(files[-1]) == os.path.getsize(files[-1])
+
+        # Truncate a copy of the classic file partway through its last record
+        truncated = os.path.join(directory, 'output.scream.test.1994-10-04-00000.nc')
+        write_file(truncated, 'NETCDF3_CLASSIC', start=3)
+        os.truncate(truncated, os.path.getsize(truncated) - 10)
+
+        results = scan_files(files + [truncated])
+        assert [r['status'] for r in results] == ['ok', 'ok', 'ok', 'truncated']
+        # Valid CDF5 files must not drop out of the sequence and leave a gap
+        assert check_stream(results)['gaps'] == []
+
+
+if __name__ == '__main__':
+    test_scan_files()
+    print('done')
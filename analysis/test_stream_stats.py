@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+
+import numpy, dask.array, xarray
+from stream_stats import QuantileSketch, get_stats
+
+percentiles = [0, 1, 5, 25, 50, 75, 95, 99, 100]
+
+
+def make_data(seed=0, n=200000):
+    # Skewed, precipitation-like and signed data sets
+    rng = numpy.random.default_rng(seed)
+    return dict(
+        lognormal=rng.lognormal(0, 5, n),
+        precipitation=numpy.where(rng.uniform(size=n) < 0.7, 0, rng.lognormal(-12, 2, n)),
+        temperature=rng.normal(280, 15, n),
+        signed=rng.normal(0, 1, n)**3,
+    )
+
+
+def test_quantile_sketch():
+    for name, values in make_data().items():
+        sketch = QuantileSketch().update(values)
+        expected = numpy.nanpercentile(values, percentiles)
+        # Relative accuracy, except between values of opposite sign around
+        # zero where the quantile itself is close to zero
+        tolerance = 2 * (sketch.gamma - 1) * numpy.abs(expected) + 1e-3 * numpy.std(values) * (name == 'signed')
+        assert numpy.all(numpy.abs(sketch.percentile(percentiles) - expected) <= tolerance), name
+
+
+def test_quantile_sketch_merge():
+    for name, values in make_data(seed=1).items():
+        values[::17] = numpy.nan
+        sketches = [QuantileSketch().update(v) for v in numpy.array_split(values, 9)]
+        forward, backward = sketches[0].copy(), sketches[-1].copy()
+        for s in sketches[1:]: forward.merge(s)
+        for s in sketches[-2::-1]: backward.merge(s)
+        numpy.testing.assert_array_equal(forward.percentile(percentiles), backward.percentile(percentiles))
+        assert (forward.count, forward.nan_count) == (numpy.isfinite(values).sum(), numpy.isnan(values).sum())
+        expected = numpy.nanpercentile(values, percentiles)
+        tolerance = 2 * (forward.gamma - 1) * numpy.abs(expected) + 1e-3 * numpy.nanstd(values) * (name == 'signed')
+        assert numpy.all(numpy.abs(forward.percentile(percentiles) - expected) <= tolerance), name
+
+
+def test_quantile_sketch_array():
+    # Sketches rebuilt from their bins and attributes (as stored per file by
+    # reduction_store) give the same quantiles
+    for name, values in make_data(seed=2).items():
+        sketch = QuantileSketch().update(values)
+        rebuilt = QuantileSketch.from_array(sketch.to_array(), sketch.attributes())
+        numpy.testing.assert_array_equal(rebuilt.percentile(percentiles), sketch.percentile(percentiles))
+    empty = QuantileSketch()
+    assert numpy.isnan(QuantileSketch.from_array(empty.to_array(), empty.attributes()).min)
+
+def test_get_stats_empty():
+    # No valid values gives NaN statistics, as numpy.nanmin and nanmax do
+    data = xarray.DataArray(dask.array.full((4, 6), numpy.nan, chunks=2), dims=('time', 'ncol'))
+    empty = xarray.DataArray(numpy.zeros((0,)), dims=('ncol',))
+    for stats in get_stats(data, empty, weights=[xarray.ones_like(data), None]):
+        assert numpy.isnan([stats.min, stats.max, stats.mean, stats.percentile(50)]).all()
+
+
+if __name__ == '__main__':
+    test_quantile_sketch()
+    test_quantile_sketch_merge()
+    test_quantile_sketch_array()
+    test_get_stats_empty()
+    print('done')